@@ -1,19 +1,27 @@
 # -*- coding: utf-8 -*-
 import warnings
+import functools
+import hashlib
 import logging
+import os
 import re
-import io
-import os.path
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import PIL.Image
+import click
 
-from flask import Flask, request, jsonify, abort, send_file
+from flask import Flask, request, jsonify, abort, g, redirect, url_for, \
+    copy_current_request_context
 from flask_babel import Babel, gettext as tr
 import flask_babel
 
+import database
+from cache import LRUCache
+from images import solid_png, chart_png
 from poll import Poll, NoMoreVotesError, InvalidPollError
-from formatters import format_help, format_poll, format_user_vote
+from formatters import format_help, format_poll, format_user_vote, \
+    chart_bars
+import mattermost_api
 from mattermost_api import user_locale, is_admin_user, is_team_admin
 import settings
 
@@ -22,6 +30,7 @@ app = Flask(__name__)
 app.logger.propagate = True
 
 babel = Babel(app)
+database.init_app(app)
 
 try:  # pragma: no cover
     if settings.APPLY_PROXY_FIX:
@@ -40,10 +49,112 @@ if not hasattr(settings, 'BARS_BY_DEFAULT'):
     settings.BARS_BY_DEFAULT = True
 if not hasattr(settings, 'BAR_IMG_URL'):
     settings.BAR_IMG_URL = None
+if not hasattr(settings, 'BAR_STYLE'):
+    settings.BAR_STYLE = 'image'
+if not hasattr(settings, 'BAR_TEXT_WIDTH'):
+    settings.BAR_TEXT_WIDTH = 10
+if not hasattr(settings, 'BAR_SENDFILE'):
+    settings.BAR_SENDFILE = None
+if not hasattr(settings, 'BAR_SENDFILE_PATH'):
+    settings.BAR_SENDFILE_PATH = '/bars/'
 if not hasattr(settings, 'DEFAULT_QUESTION'):
     settings.DEFAULT_QUESTION = ''
 if not hasattr(settings, 'DEFAULT_VOTES'):
     settings.DEFAULT_VOTES = []
+if not hasattr(settings, 'MIGRATE_ON_STARTUP'):
+    settings.MIGRATE_ON_STARTUP = True
+
+if settings.MIGRATE_ON_STARTUP:
+    database.migrate_database()
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Migrates the database to the current schema version.
+    With MIGRATE_ON_STARTUP, the database was already migrated when the
+    app was loaded.
+    """
+    con = database.connect()
+    try:
+        before = database.schema_version(con)
+        database.migrate(con)
+        after = database.schema_version(con)
+    finally:
+        con.close()
+    if before == after:
+        print('The database is already at schema version {}.'.format(
+            after))
+    else:
+        print('Migrated the database from schema version {} to {}.'.format(
+            before, after))
+
+
+@app.cli.command('check-counts')
+@click.option('--repair', is_flag=True,
+              help='Rebuild all vote counts from the votes.')
+def check_counts_command(repair):
+    """Checks the denormalized vote counts for drift."""
+    con = database.connect()
+    try:
+        polls = database.check_vote_counts(con)
+        if polls:
+            print('Inconsistent vote counts in {} poll(s): {}'.format(
+                len(polls), ', '.join(str(p) for p in polls)))
+        else:
+            print('All vote counts are consistent.')
+        if polls and repair:
+            database.rebuild_vote_counts(con)
+            print('Rebuilt all vote counts.')
+    finally:
+        con.close()
+
+
+@app.cli.command('convert-ballots')
+def convert_ballots_command():
+    """Converts the votes of all polls to bitmask ballots."""
+    con = database.connect()
+    try:
+        converted = database.convert_ballots(con)
+    finally:
+        con.close()
+    print('Converted {} poll(s).'.format(converted))
+
+
+@app.cli.command('clear-renders')
+@click.argument('poll_id', type=int, required=False)
+def clear_renders_command(poll_id):
+    """Deletes the stored messages of finished polls.
+    They are rendered again on the next request.
+    """
+    con = database.connect()
+    try:
+        deleted = database.clear_renders(con, poll_id)
+    finally:
+        con.close()
+    print('Deleted {} stored message(s).'.format(deleted))
+
+
+@app.cli.command('clear-user-cache')
+@click.option('--expired', is_flag=True,
+              help='Only delete expired entries.')
+def clear_user_cache_command(expired):
+    """Deletes the cached users, team roles and usernames."""
+    deleted = mattermost_api.user_cache.clear(expired_only=expired)
+    print('Deleted {} cached entries.'.format(deleted))
+
+
+@app.cli.command('export-bars')
+@click.argument('directory', type=click.Path(file_okay=False))
+def export_bars_command(directory):
+    """Writes all bar images (bar_<width>.png) to DIRECTORY, so that a
+    reverse proxy can serve them (see BAR_SENDFILE).
+    """
+    os.makedirs(directory, exist_ok=True)
+    for width in range(1, MAX_BAR_WIDTH + 1):
+        filename = 'bar_{}.png'.format(width)
+        with open(os.path.join(directory, filename), 'wb') as f:
+            f.write(render_bar(filename).png)
+    print('Exported {} bar images to {}.'.format(MAX_BAR_WIDTH, directory))
 
 
 def parse_slash_command(command):
@@ -111,9 +222,12 @@ def parse_slash_command(command):
 
 @babel.localeselector
 def get_locale():
-    """Returns the locale for the current request."""
+    """Returns the locale for the current request.
+    If the Mattermost API is unavailable, the locale of the poll is used.
+    """
     try:
-        return user_locale(request.user_id)
+        return user_locale(request.user_id,
+                           getattr(request, 'poll_locale', 'en'))
     except AttributeError as e:
         app.logger.warning(e)
     return "en"
@@ -124,7 +238,9 @@ def log_response(response):
     """Logs the complete response for debugging."""
     if app.logger.isEnabledFor(logging.DEBUG):
         app.logger.debug('Response status: %s', response.status)
-        if not response.direct_passthrough:  # excludes send_file
+        # images are binary
+        if not response.direct_passthrough and \
+                not response.mimetype.startswith('image/'):
             app.logger.debug('Response data: %s',
                              response.get_data().decode('utf-8'))
     return response
@@ -267,6 +383,7 @@ def vote():
             'ephemeral_text': tr("This poll is not valid anymore.\n"
                                  "Sorry for the inconvenience.")
         })
+    request.poll_locale = poll.locale
 
     app.logger.info('Voting in poll "%s" for user "%s": %i',
                     poll_id, user_id, vote_id)
@@ -287,6 +404,47 @@ def vote():
     })
 
 
+# Threads for the role checks of `_is_any_admin`, shared by all requests.
+# The threads are only started on first use, so forked workers do not
+# inherit them.
+admin_check_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'ADMIN_CHECK_WORKERS', 8),
+    thread_name_prefix='admin-check')
+
+
+def _is_any_admin(user_id, team_id):
+    """Returns whether the user is a system admin or an admin of the team.
+    Both roles are checked concurrently. As soon as one check succeeds the
+    other one is cancelled (or no longer awaited if it already started).
+    The checks share the memoized Mattermost lookups of the request.
+    """
+    if 'mattermost_lookups' not in g:
+        g.mattermost_lookups = {}
+    lookups = g.mattermost_lookups
+
+    def in_request(check, **kwargs):
+        @copy_current_request_context
+        def run():
+            # the copied request context has its own app context and g
+            g.mattermost_lookups = lookups
+            return check(**kwargs)
+        return run
+
+    futures = [
+        admin_check_executor.submit(in_request(is_admin_user,
+                                               user_id=user_id)),
+        admin_check_executor.submit(in_request(is_team_admin,
+                                               user_id=user_id,
+                                               team_id=team_id)),
+    ]
+    for future in as_completed(futures):
+        if future.result():
+            for other in futures:
+                other.cancel()
+            return True
+    return False
+
+
 @app.route('/end', methods=['POST'])
 def end_poll():
     """Ends the poll.
@@ -307,14 +465,14 @@ def end_poll():
             'ephemeral_text': tr("This poll is not valid anymore.\n"
                                  "Sorry for the inconvenience.")
         })
+    request.poll_locale = poll.locale
 
     app.logger.info('Ending poll "%s"', poll_id)
 
     # only the creator and admins may end a poll
     can_end_poll = \
         user_id == poll.creator_id or \
-        is_admin_user(user_id) or \
-        is_team_admin(user_id=user_id, team_id=team_id)
+        _is_any_admin(user_id, team_id)
 
     if can_end_poll:
         poll.end()
@@ -329,20 +487,146 @@ def end_poll():
     })
 
 
-bar_image_pattern = re.compile(r"^bar_(\d{1,3}).png$")
-bar_image = PIL.Image.open(os.path.join(app.root_path, 'img', 'bar.png'))
+bar_image_pattern = re.compile(r"^bar_([1-9]\d{0,2})\.png$")
+MAX_BAR_WIDTH = 999
+# size and colour of the bars, like img/bar.png
+BAR_HEIGHT = 25
+BAR_COLOR = (35, 137, 215, 255)
+
+
+BarImage = namedtuple('BarImage', ['png', 'etag'])
+
+# Bar images never change for a given width, so clients and proxies may
+# cache them forever.
+BAR_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+@functools.lru_cache(maxsize=1000)
+def _bar_image(bar_width):
+    png = solid_png(bar_width, BAR_HEIGHT, BAR_COLOR)
+    return BarImage(png, hashlib.sha1(png).hexdigest())
+
+
+def bar_image_width(filename):
+    """Returns the width of the bar with the given file name
+    (bar_<width>.png) or None if the name is invalid.
+    """
+    match = re.match(bar_image_pattern, filename)
+    if not match:
+        return None
+    return int(match[1])
+
+
+def render_bar(filename):
+    """Returns the `BarImage` with the PNG data and the ETag of the bar
+    with the given file name (bar_<width>.png) or None if the name is
+    invalid.
+    Each width is only rendered once.
+    """
+    width = bar_image_width(filename)
+    if width is None:
+        return None
+    return _bar_image(width)
+
+
+SENDFILE_HEADERS = {
+    'x-accel-redirect': 'X-Accel-Redirect',
+    'x-sendfile': 'X-Sendfile',
+}
+
+
+def bar_sendfile_header(filename):
+    """Returns the name and value of the header which lets the reverse
+    proxy send the exported bar image with the given (valid) file name,
+    or None if the images are sent by the poll server (see BAR_SENDFILE
+    and the export-bars command).
+    """
+    header = SENDFILE_HEADERS.get(settings.BAR_SENDFILE)
+    if header is None:
+        return None
+    return header, settings.BAR_SENDFILE_PATH + filename
 
 
 @app.route('/img/<path:filename>')
 def send_img(filename):
-    match = re.match(bar_image_pattern, filename)
-    if match:
-        # resize the 1px template image to the requested width
-        bar_width = int(match[1])
-        bar_resized = bar_image.resize((bar_width, bar_image.height))
-        buffer = io.BytesIO()
-        bar_resized.save(buffer, "PNG")
-        buffer.seek(0)
-        return send_file(buffer, mimetype="image/png")
-    else:
+    if bar_image_width(filename) is None:
         abort(400)
+    sendfile = bar_sendfile_header(filename)
+    if sendfile is not None:
+        response = app.response_class(mimetype="image/png")
+        response.headers[sendfile[0]] = sendfile[1]
+        response.headers['Cache-Control'] = BAR_CACHE_CONTROL
+        return response
+
+    bar = render_bar(filename)
+    response = app.response_class(bar.png, mimetype="image/png")
+    response.set_etag(bar.etag)
+    response.headers['Cache-Control'] = BAR_CACHE_CONTROL
+    return response.make_conditional(request)
+
+
+# gap between the bars of a chart and colour of its labels (readable on
+# light and dark themes)
+CHART_GAP = 6
+CHART_LABEL_COLOR = (128, 128, 128, 255)
+CHART_LABEL_SCALE = 3
+
+# A chart never changes for a given poll version, so each is only
+# rendered once. Only the current version of a poll is rendered.
+chart_cache = LRUCache(getattr(settings, 'CHART_CACHE_SIZE', 256))
+
+
+def render_chart(poll, snapshot):
+    """Returns the `BarImage` with the PNG data and the ETag of the bar
+    chart of the poll at the version of `snapshot` (see BAR_STYLE
+    'chart') or None if the poll does not show a chart.
+    """
+    if not poll.bars or (poll.secret and not snapshot.finished):
+        return None
+    key = (poll.id, snapshot.version)
+    chart = chart_cache.get(key)
+    if chart is not None:
+        return chart
+
+    bars = chart_bars(poll, snapshot)
+    if not bars:
+        return None
+    png = chart_png(bars, BAR_HEIGHT, CHART_GAP, BAR_COLOR,
+                    CHART_LABEL_COLOR, CHART_LABEL_SCALE)
+    chart = BarImage(png, hashlib.sha1(png).hexdigest())
+    chart_cache.put(key, chart)
+    return chart
+
+
+@app.route('/img/chart/<int:poll_id>/<int:version>.png')
+def send_chart(poll_id, version):
+    """Sends the chart of the poll at `version`.
+    Older versions are redirected to the current one, so charts in
+    messages that were not updated yet show the current votes, and
+    charts of finished polls always show the final votes.
+    """
+    chart = chart_cache.get((poll_id, version))
+    if chart is None:
+        try:
+            poll = Poll.load(poll_id)
+        except InvalidPollError:
+            abort(404)
+        snapshot = poll.snapshot()
+        if version > snapshot.version:
+            abort(404)
+        chart = render_chart(poll, snapshot)
+        if chart is None:
+            abort(404)
+        if version != snapshot.version:
+            response = redirect(
+                url_for('send_chart', poll_id=poll_id,
+                        version=snapshot.version),
+                301 if snapshot.finished else 302)
+            if not snapshot.finished:
+                response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+    response = app.response_class(chart.png, mimetype="image/png")
+    response.set_etag(chart.etag)
+    response.headers['Cache-Control'] = BAR_CACHE_CONTROL
+    return response.make_conditional(request)
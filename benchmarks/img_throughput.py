@@ -0,0 +1,52 @@
+"""Measures the throughput of the bar images (/img) of the Flask app.
+
+Compares rendering each image again (uncached), the cached images and
+revalidation requests answered with 304 Not Modified. Run from the
+repository root with a settings.py on the path:
+
+    python benchmarks/img_throughput.py --requests 2000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import app  # noqa: E402
+
+
+def run(client, num_requests, clear_cache=False, etags=None):
+    begin = time.perf_counter()
+    for i in range(num_requests):
+        width = 2 + i % 449
+        if clear_cache:
+            app._bar_image.cache_clear()
+        headers = {'If-None-Match': etags[width]} if etags else {}
+        response = client.get('/img/bar_{}.png'.format(width),
+                              headers=headers)
+        assert response.status_code in (200, 304)
+    return num_requests / (time.perf_counter() - begin)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    client = app.app.test_client()
+    etags = {
+        width: client.get('/img/bar_{}.png'.format(width)).headers['ETag']
+        for width in range(2, 451)
+    }
+
+    print('{:<12} {:>12}'.format('mode', 'requests/s'))
+    for name, kwargs in (('uncached', {'clear_cache': True}),
+                         ('cached', {}),
+                         ('304', {'etags': etags})):
+        rate = run(client, args.requests, **kwargs)
+        print('{:<12} {:>12.0f}'.format(name, rate))
+
+
+if __name__ == '__main__':
+    main()
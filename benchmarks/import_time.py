@@ -0,0 +1,56 @@
+"""Prints the modules with the largest cumulative import time when
+importing the app (`python -X importtime`). Run from the repository root
+with a settings.py on the path:
+
+    python benchmarks/import_time.py --module app --top 15
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+
+def imported_modules(module, path=()):
+    """Returns the cumulative import time in microseconds of all modules
+    imported by `import module` in a new interpreter. `path` and the
+    repository root are prepended to its PYTHONPATH.
+    The database is replaced by a temporary one, so migrating it on import
+    leaves the configured database alone.
+    """
+    python_path = list(path) + [ROOT, os.environ.get('PYTHONPATH', '')]
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(p for p in python_path if p))
+    with tempfile.TemporaryDirectory() as tmp:
+        code = 'import settings; settings.DATABASE = {!r}; import {}'.format(
+            os.path.join(tmp, 'import_time.db'), module)
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            cwd=ROOT, env=env, stderr=subprocess.PIPE, check=True,
+            universal_newlines=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    modules = imported_modules(args.module)
+    print('{:<40} {:>10}'.format('module', 'cum. ms'))
+    for name, cumulative in sorted(modules.items(), key=lambda m: -m[1]
+                                   )[:args.top]:
+        print('{:<40} {:>10.1f}'.format(name, cumulative / 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Measures the latency of Mattermost API calls against a local stub server.
+
+Compares a new connection per call (plain `requests.get`) with the pooled
+keep-alive session of `mattermost_api.session`. Run from the repository
+root with a settings.py on the path:
+
+    python benchmarks/mattermost_client.py --calls 500
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import mattermost_api  # noqa: E402
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers every GET with a small user object, like
+    /api/v4/users/<user_id>.
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    # the headers and the body are written separately
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = json.dumps({
+            'id': self.path.rsplit('/', 1)[-1],
+            'locale': 'en',
+            'roles': 'system_user',
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def measure(get, url, num_calls):
+    """Returns the per call latencies in milliseconds."""
+    latencies = []
+    for i in range(num_calls):
+        begin = time.perf_counter()
+        r = get(url + str(i), headers={'Authorization': 'Bearer token'})
+        r.json()
+        latencies.append((time.perf_counter() - begin) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=500)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/api/v4/users/'.format(server.server_port)
+
+    clients = [
+        ('requests.get', requests.get),
+        ('session', mattermost_api.session().get),
+    ]
+    print('{:<14} {:>10} {:>10} {:>10}'.format(
+        'client', 'mean ms', 'p50 ms', 'p99 ms'))
+    for name, get in clients:
+        latencies = sorted(measure(get, url, args.calls))
+        print('{:<14} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+            name, statistics.mean(latencies),
+            latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.99)]))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
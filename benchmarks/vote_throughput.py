@@ -0,0 +1,87 @@
+"""Measures the concurrent vote throughput for each DATABASE_PROFILE.
+
+Several processes (like gunicorn workers) vote in the same poll as fast as
+possible. Run from the repository root with a settings.py on the path:
+
+    python benchmarks/vote_throughput.py --workers 4 --votes 500
+"""
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import database  # noqa: E402
+import settings  # noqa: E402
+from poll import Poll, InvalidPollError  # noqa: E402
+
+
+def configure(path, profile):
+    settings.DATABASE = path
+    settings.DATABASE_PROFILE = profile
+
+
+def worker(path, profile, poll_id, worker_id, num_votes, start, results):
+    configure(path, profile)
+    errors = 0
+    start.wait()
+    for i in range(num_votes):
+        try:
+            poll = Poll.load(poll_id)
+            poll.vote('user{}-{}'.format(worker_id, i),
+                      i % len(poll.vote_options))
+        except (InvalidPollError, sqlite3.OperationalError):
+            errors += 1
+    results.put(errors)
+
+
+def run(profile, num_workers, num_votes):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        configure(path, profile)
+        database.migrate_database()
+        poll_id = Poll.create('user0', 'Benchmark', 'en',
+                              ['Yes', 'No', 'Maybe']).id
+
+        start = multiprocessing.Barrier(num_workers + 1)
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=worker,
+                args=(path, profile, poll_id, i, num_votes, start, results))
+            for i in range(num_workers)
+        ]
+        for process in processes:
+            process.start()
+        start.wait()
+        begin = time.perf_counter()
+        errors = sum(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - begin
+
+    total = num_workers * num_votes
+    return (total - errors) / elapsed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--votes', type=int, default=500,
+                        help='votes per worker')
+    parser.add_argument('profiles', nargs='*',
+                        default=sorted(database.PROFILES))
+    args = parser.parse_args()
+
+    print('{:<12} {:>12} {:>8}'.format('profile', 'votes/s', 'errors'))
+    for profile in args.profiles:
+        rate, errors = run(profile, args.workers, args.votes)
+        print('{:<12} {:>12.0f} {:>8}'.format(profile, rate, errors))
+
+
+if __name__ == '__main__':
+    main()
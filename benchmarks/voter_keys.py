@@ -0,0 +1,112 @@
+"""Compares database size and query times before and after interning the
+voter ids (schema version 3 -> 4) on a synthetic dataset.
+
+    python benchmarks/voter_keys.py --polls 2000 --voters 200
+"""
+import argparse
+import os
+import random
+import sqlite3
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import database  # noqa: E402
+
+# (description, query before, query after, parameters from a sample)
+QUERIES = [
+    ('votes of a user',
+     """SELECT vote FROM Votes WHERE poll_id=? AND voter=?""",
+     """SELECT vote FROM Votes
+        WHERE poll_id=? AND voter=(
+            SELECT id FROM Voters WHERE mm_user_id=?)""",
+     lambda poll_id, user: (poll_id, user)),
+    ('voters of an option',
+     """SELECT voter FROM Votes WHERE poll_id=? AND vote=0""",
+     """SELECT mm_user_id FROM Votes JOIN Voters ON Voters.id=Votes.voter
+        WHERE poll_id=? AND vote=0""",
+     lambda poll_id, user: (poll_id,)),
+]
+
+
+def user_id(rng):
+    return ''.join(rng.choice(string.ascii_lowercase + string.digits)
+                   for _ in range(26))
+
+
+def populate(con, num_polls, voters_per_poll, num_users, seed=0):
+    rng = random.Random(seed)
+    users = [user_id(rng) for _ in range(num_users)]
+    with database.transaction(con) as cur:
+        for poll_id in range(1, num_polls + 1):
+            cur.execute("""INSERT INTO Polls
+                           (poll_id, creator, message, locale, finished,
+                            secret, public, max_votes, bars)
+                           VALUES (?, ?, 'Poll', 'en', 1, 0, 0, 2, 0)""",
+                        (poll_id, users[0]))
+            cur.executemany("""INSERT INTO VoteOptions VALUES (?, ?, ?)""",
+                            [(poll_id, n, 'Option') for n in range(5)])
+            votes = set()
+            for voter in rng.sample(users, voters_per_poll):
+                for vote in rng.sample(range(5), rng.randint(1, 2)):
+                    votes.add((poll_id, voter, vote))
+            cur.executemany("""INSERT INTO Votes VALUES (?, ?, ?)""",
+                            sorted(votes))
+    return users
+
+
+def size(con):
+    con.execute("""VACUUM""")
+    page_count = con.execute("""PRAGMA page_count""").fetchone()[0]
+    page_size = con.execute("""PRAGMA page_size""").fetchone()[0]
+    return page_count * page_size
+
+
+def timing(con, query, parameters, samples):
+    begin = time.perf_counter()
+    for sample in samples:
+        con.execute(query, parameters(*sample)).fetchall()
+    return (time.perf_counter() - begin) / len(samples) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--polls', type=int, default=2000)
+    parser.add_argument('--voters', type=int, default=200,
+                        help='voters per poll')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--samples', type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        con = sqlite3.connect(os.path.join(directory, 'bench.db'))
+        database.migrate(con, target=3)
+        users = populate(con, args.polls, args.voters, args.users)
+        num_votes = con.execute("""SELECT COUNT(*) FROM Votes""").fetchone()[0]
+
+        rng = random.Random(1)
+        samples = [(rng.randint(1, args.polls), rng.choice(users))
+                   for _ in range(args.samples)]
+
+        before = [size(con)] + [timing(con, q, p, samples)
+                                for _, q, _, p in QUERIES]
+        begin = time.perf_counter()
+        database.migrate(con, target=4)
+        migration = time.perf_counter() - begin
+        after = [size(con)] + [timing(con, q, p, samples)
+                               for _, _, q, p in QUERIES]
+
+    print('{} polls, {} votes, migration took {:.1f}s'.format(
+        args.polls, num_votes, migration))
+    print('{:<22} {:>12} {:>12}'.format('', 'text voter', 'int voter'))
+    print('{:<22} {:>10.1f}MB {:>10.1f}MB'.format(
+        'database size', before[0] / 2**20, after[0] / 2**20))
+    for (name, _, _, _), b, a in zip(QUERIES, before[1:], after[1:]):
+        print('{:<22} {:>10.1f}us {:>10.1f}us'.format(name, b, a))
+
+
+if __name__ == '__main__':
+    main()
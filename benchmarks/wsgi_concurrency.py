@@ -0,0 +1,84 @@
+"""Compares the request throughput of gunicorn's sync and gthread workers
+when every request waits on a slow Mattermost API.
+
+'sync' runs the WSGI app with --workers requests in flight (like
+gunicorn's sync workers), 'gthread' with --threads requests in flight
+(like `gunicorn --threads`). Run from the repository root with a
+settings.py on the path:
+
+    python benchmarks/wsgi_concurrency.py --requests 200 --latency 0.05
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import tempfile
+import time
+
+from werkzeug.test import EnvironBuilder
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import settings  # noqa: E402
+
+settings.DATABASE = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import app  # noqa: E402
+from poll import Poll  # noqa: E402
+
+
+def vote_body(poll_id, i):
+    return json.dumps({
+        'user_id': 'user{}'.format(i),
+        'context': {'poll_id': poll_id, 'vote': i % 2},
+    }).encode()
+
+
+def run_wsgi(poll_id, num_requests, in_flight):
+    def request(i):
+        environ = EnvironBuilder(path='/vote', method='POST',
+                                 data=vote_body(poll_id, i),
+                                 content_type='application/json'
+                                 ).get_environ()
+        statuses = []
+        body = app.app.wsgi_app(
+            environ, lambda status, headers: statuses.append(status))
+        b''.join(body)
+        return statuses[0]
+
+    with ThreadPoolExecutor(max_workers=in_flight) as executor:
+        return list(executor.map(request, range(num_requests)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds per Mattermost API call')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=32)
+    args = parser.parse_args()
+
+    def slow_user_locale(user_id, fallback='en'):
+        time.sleep(args.latency)
+        return 'en'
+
+    app.user_locale = slow_user_locale
+
+    print('{:<8} {:>10} {:>12} {:>10}'.format(
+        'workers', 'in flight', 'requests/s', 'errors'))
+    for name, limit in (('sync', args.workers), ('gthread', args.threads)):
+        with app.app.app_context():
+            poll_id = Poll.create('user0', 'Benchmark', 'en',
+                                  ['Yes', 'No']).id
+        begin = time.perf_counter()
+        statuses = run_wsgi(poll_id, args.requests, limit)
+        elapsed = time.perf_counter() - begin
+        errors = sum(1 for status in statuses if status != '200 OK')
+        print('{:<8} {:>10} {:>12.0f} {:>10}'.format(
+            name, limit, args.requests / elapsed, errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""In-process caches and a cache shared by all processes."""
+from collections import OrderedDict
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import database
+
+logger = logging.getLogger('flask.app')
+
+
+class LRUCache:
+    """A thread-safe mapping with a maximum size that evicts the least
+    recently used entries first.
+
+    Attributes
+    ----------
+    maxsize: int
+        Maximum number of entries. A maxsize of 0 disables the cache.
+    ttl: float
+        Seconds after which an entry expires or None to keep entries
+        until they are evicted.
+    hits: int
+        Number of successful lookups.
+    misses: int
+        Number of lookups of missing or expired entries.
+    """
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the value of `key` or `default` if there is no (valid)
+        entry.
+        """
+        with self._lock:
+            try:
+                value, expires = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Adds or replaces the entry of `key`."""
+        if self.maxsize <= 0:
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        """Removes the entry of `key` if it exists."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes all entries and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns a dict with the size, hits, misses and hit rate."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class DatabaseCache:
+    """A cache of JSON serializable values in the Cache table of the
+    database. It is shared by all server processes and kept across
+    restarts.
+    Values that only state that something does not exist (e.g. an
+    unknown user) can be stored with the shorter `negative_ttl`.
+    Writes are best-effort: if the database is busy, the values are
+    not cached.
+    Expired entries are removed in a background thread started by
+    `put_many` at most every `purge_interval` seconds per process, so
+    the table does not grow without bound.
+    The counters only cover the lookups of the current process.
+
+    Attributes
+    ----------
+    ttl: float
+        Seconds after which an entry expires. A ttl of 0 disables the
+        cache.
+    negative_ttl: float
+        Seconds after which a negative entry expires.
+    purge_interval: float
+        Minimum number of seconds between two removals of the expired
+        entries.
+    hits: int
+        Number of successful lookups.
+    misses: int
+        Number of lookups of missing or expired entries.
+    """
+    # maximum number of keys in a single query of `get_many`
+    _max_keys = 500
+
+    def __init__(self, ttl, negative_ttl=None, purge_interval=60):
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.purge_interval = purge_interval
+        self.hits = 0
+        self.misses = 0
+        self._next_purge = 0.0
+        self._purge_thread = None
+        self._lock = threading.Lock()
+
+    def _purge_due(self, now):
+        """Returns whether the expired entries should be removed now."""
+        with self._lock:
+            if now < self._next_purge:
+                return False
+            self._next_purge = now + self.purge_interval
+            return True
+
+    def _purge(self, now):
+        """Removes the entries that expired before `now` with a
+        connection of its own.
+        """
+        con = None
+        try:
+            con = database.connect()
+            with database.transaction(con) as cur:
+                cur.execute("""DELETE FROM Cache WHERE expires <= ?""",
+                            (now,))
+        except sqlite3.OperationalError as e:
+            logger.warning('Failed to remove expired cache entries: %s', e)
+        finally:
+            if con is not None:
+                con.close()
+
+    def _count(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def get(self, key, default=None):
+        """Returns the value of `key` or `default` if there is no (valid)
+        entry.
+        """
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        """Returns a dict with the values of all `keys` that have a
+        (valid) entry.
+        """
+        keys = list(keys)
+        if self.ttl <= 0:
+            return {}
+        values = {}
+        cur = database.connection().cursor()
+        now = time.time()
+        for i in range(0, len(keys), self._max_keys):
+            chunk = keys[i:i + self._max_keys]
+            cur.execute("""SELECT key, value FROM Cache
+                           WHERE key IN ({}) AND expires > ?""".format(
+                               ', '.join('?' * len(chunk))),
+                        chunk + [now])
+            for key, value in cur.fetchall():
+                values[key] = json.loads(value)
+        self._count(len(values), len(keys) - len(values))
+        return values
+
+    def put(self, key, value, negative=False):
+        """Adds or replaces the entry of `key`."""
+        self.put_many({key: value}, negative)
+
+    def put_many(self, values, negative=False):
+        """Adds or replaces the entries of all keys in the dict `values`.
+        Failed writes are logged and otherwise ignored.
+        """
+        ttl = self.negative_ttl if negative else self.ttl
+        if self.ttl <= 0 or ttl <= 0 or not values:
+            return
+        now = time.time()
+        expires = now + ttl
+        if self._purge_due(now):
+            # the caller does not wait for the DELETE
+            self._purge_thread = threading.Thread(
+                target=self._purge, args=(now,), name='cache-purge',
+                daemon=True)
+            self._purge_thread.start()
+        try:
+            with database.transaction(database.connection()) as cur:
+                cur.executemany("""INSERT OR REPLACE INTO Cache
+                                   (key, value, expires) VALUES (?, ?, ?)""",
+                                [(key, json.dumps(value), expires)
+                                 for key, value in values.items()])
+        except sqlite3.OperationalError as e:
+            logger.warning('Failed to cache %d values: %s', len(values), e)
+
+    def clear(self, expired_only=False):
+        """Removes all (or only the expired) entries of all processes,
+        resets the counters and returns the number of removed entries.
+        """
+        with database.transaction(database.connection()) as cur:
+            if expired_only:
+                cur.execute("""DELETE FROM Cache WHERE expires <= ?""",
+                            (time.time(),))
+            else:
+                cur.execute("""DELETE FROM Cache""")
+            removed = cur.rowcount
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+        return removed
+
+    def stats(self):
+        """Returns a dict with the size, hits, misses and hit rate."""
+        cur = database.connection().cursor()
+        cur.execute("""SELECT COUNT(*) FROM Cache WHERE expires > ?""",
+                    (time.time(),))
+        size = cur.fetchone()[0]
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,818 @@
+# -*- coding: utf-8 -*-
+"""Database connections and schema migrations.
+
+The schema version is stored in `PRAGMA user_version`. Each entry in
+`MIGRATIONS` upgrades the schema by exactly one version, so a database
+with `user_version = n` has all migrations up to `MIGRATIONS[n-1]`
+applied.
+Migrations are applied once when the server starts (see `migrate_database`)
+or explicitly with `flask --app app migrate`. Requests never execute DDL.
+
+Every new connection is configured with the PRAGMAs of the
+`DATABASE_PROFILE` setting (see `PROFILES`).
+Connections are kept in a per-process `ConnectionPool`. During a request
+`connection()` hands out a pooled connection that is returned when the
+Flask app context is torn down (see `init_app`).
+
+If DATABASE_GROUP_COMMIT_MS is set, write operations can be batched
+into a shared transaction with `group_committer()`.
+"""
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import contextlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g, has_app_context
+
+import settings
+
+logger = logging.getLogger('flask.app')
+
+
+def _columns(cur, table):
+    cur.execute("""PRAGMA table_info({})""".format(table))
+    return [c[1] for c in cur.fetchall()]
+
+
+def _create_tables(cur):
+    """Version 1: Polls, VoteOptions and Votes.
+    Databases created before schema versioning was introduced might
+    already contain the tables but lack the 'bars' and 'locale' columns.
+    """
+    cur.execute("""CREATE TABLE IF NOT EXISTS Polls (
+                   poll_id integer PRIMARY KEY,
+                   creator text NOT NULL,
+                   message text NOT NULL,
+                   locale text NOT NULL,
+                   finished integer NOT NULL,
+                   secret integer NOT NULL,
+                   public integer NOT NULL,
+                   max_votes integer NOT NULL,
+                   bars integer NOT NULL)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS VoteOptions (
+                   poll_id integer REFERENCES Polls (poll_id)
+                   ON DELETE CASCADE ON UPDATE NO ACTION,
+                   number integer NOT NULL,
+                   name text NOT NULL)""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS Votes (
+                   poll_id integer REFERENCES Polls (poll_id)
+                   ON DELETE CASCADE ON UPDATE NO ACTION,
+                   voter text NOT NULL,
+                   vote integer NOT NULL,
+                   CONSTRAINT single_vote UNIQUE
+                   (poll_id, voter, vote) ON CONFLICT REPLACE)""")
+
+    if 'bars' not in _columns(cur, 'Polls'):
+        logger.info("Outdated database version detected, "
+                    "adding 'bars' column.")
+        cur.execute("""ALTER TABLE Polls
+                       ADD COLUMN bars integer NOT NULL DEFAULT 0""")
+
+    if 'locale' not in _columns(cur, 'Polls'):
+        logger.info("Outdated database version detected, "
+                    "adding 'locale' column.")
+        cur.execute("""ALTER TABLE Polls
+                       ADD COLUMN locale text NOT NULL DEFAULT "en" """)
+
+
+def _create_indexes(cur):
+    """Version 2: Indexes for all queries in poll.py.
+    Votes is already indexed by (poll_id, voter, vote) through the
+    single_vote constraint. The additional index covers the lookups
+    by option.
+    """
+    cur.execute("""CREATE INDEX IF NOT EXISTS VoteOptions_poll
+                   ON VoteOptions (poll_id, number)""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS Votes_poll_vote
+                   ON Votes (poll_id, vote, voter)""")
+
+
+def _create_vote_counts(cur):
+    """Version 3: Denormalized vote counts maintained by triggers.
+    VoteCounts holds the number of votes of each option and Polls the
+    total number of votes and voters, so counting never has to scan the
+    Votes of a poll.
+    """
+    cur.execute("""CREATE TABLE VoteCounts (
+                   poll_id integer REFERENCES Polls (poll_id)
+                   ON DELETE CASCADE ON UPDATE NO ACTION,
+                   number integer NOT NULL,
+                   count integer NOT NULL DEFAULT 0,
+                   PRIMARY KEY (poll_id, number)) WITHOUT ROWID""")
+    cur.execute("""ALTER TABLE Polls
+                   ADD COLUMN num_votes integer NOT NULL DEFAULT 0""")
+    cur.execute("""ALTER TABLE Polls
+                   ADD COLUMN num_voters integer NOT NULL DEFAULT 0""")
+
+    cur.execute("""CREATE TRIGGER VoteOptions_insert
+                   AFTER INSERT ON VoteOptions
+                   BEGIN
+                       INSERT INTO VoteCounts (poll_id, number, count)
+                       VALUES (NEW.poll_id, NEW.number, 0);
+                   END""")
+    cur.execute("""CREATE TRIGGER Votes_insert
+                   AFTER INSERT ON Votes
+                   BEGIN
+                       UPDATE VoteCounts SET count = count + 1
+                       WHERE poll_id=NEW.poll_id AND number=NEW.vote;
+                       UPDATE Polls SET
+                           num_votes = num_votes + 1,
+                           num_voters = num_voters + NOT EXISTS (
+                               SELECT 1 FROM Votes
+                               WHERE poll_id=NEW.poll_id
+                               AND voter=NEW.voter AND vote!=NEW.vote)
+                       WHERE poll_id=NEW.poll_id;
+                   END""")
+    cur.execute("""CREATE TRIGGER Votes_delete
+                   AFTER DELETE ON Votes
+                   BEGIN
+                       UPDATE VoteCounts SET count = count - 1
+                       WHERE poll_id=OLD.poll_id AND number=OLD.vote;
+                       UPDATE Polls SET
+                           num_votes = num_votes - 1,
+                           num_voters = num_voters - NOT EXISTS (
+                               SELECT 1 FROM Votes
+                               WHERE poll_id=OLD.poll_id
+                               AND voter=OLD.voter)
+                       WHERE poll_id=OLD.poll_id;
+                   END""")
+
+    cur.execute("""INSERT INTO VoteCounts (poll_id, number, count)
+                   SELECT poll_id, number, (
+                       SELECT COUNT(*) FROM Votes
+                       WHERE Votes.poll_id=VoteOptions.poll_id
+                       AND Votes.vote=VoteOptions.number)
+                   FROM VoteOptions""")
+    cur.execute("""UPDATE Polls SET
+                   num_votes = (SELECT COUNT(*) FROM Votes
+                                WHERE Votes.poll_id=Polls.poll_id),
+                   num_voters = (SELECT COUNT(DISTINCT voter) FROM Votes
+                                 WHERE Votes.poll_id=Polls.poll_id)""")
+
+
+def _create_voters(cur):
+    """Version 4: Store voters as integer keys into an interning table
+    instead of repeating the 26 character Mattermost user id in every
+    vote. Votes becomes a WITHOUT ROWID table keyed by the former
+    single_vote constraint.
+    """
+    cur.execute("""CREATE TABLE Voters (
+                   id integer PRIMARY KEY,
+                   mm_user_id text NOT NULL UNIQUE)""")
+    cur.execute("""INSERT INTO Voters (mm_user_id)
+                   SELECT DISTINCT voter FROM Votes""")
+
+    cur.execute("""CREATE TABLE NewVotes (
+                   poll_id integer REFERENCES Polls (poll_id)
+                   ON DELETE CASCADE ON UPDATE NO ACTION,
+                   voter integer NOT NULL REFERENCES Voters (id),
+                   vote integer NOT NULL,
+                   CONSTRAINT single_vote PRIMARY KEY
+                   (poll_id, voter, vote) ON CONFLICT REPLACE)
+                   WITHOUT ROWID""")
+    cur.execute("""INSERT INTO NewVotes (poll_id, voter, vote)
+                   SELECT poll_id, Voters.id, vote
+                   FROM Votes JOIN Voters ON Voters.mm_user_id=Votes.voter""")
+    # also drops the index and triggers of the old table
+    cur.execute("""DROP TABLE Votes""")
+    cur.execute("""ALTER TABLE NewVotes RENAME TO Votes""")
+
+    cur.execute("""CREATE INDEX Votes_poll_vote
+                   ON Votes (poll_id, vote, voter)""")
+    cur.execute("""CREATE TRIGGER Votes_insert
+                   AFTER INSERT ON Votes
+                   BEGIN
+                       UPDATE VoteCounts SET count = count + 1
+                       WHERE poll_id=NEW.poll_id AND number=NEW.vote;
+                       UPDATE Polls SET
+                           num_votes = num_votes + 1,
+                           num_voters = num_voters + NOT EXISTS (
+                               SELECT 1 FROM Votes
+                               WHERE poll_id=NEW.poll_id
+                               AND voter=NEW.voter AND vote!=NEW.vote)
+                       WHERE poll_id=NEW.poll_id;
+                   END""")
+    cur.execute("""CREATE TRIGGER Votes_delete
+                   AFTER DELETE ON Votes
+                   BEGIN
+                       UPDATE VoteCounts SET count = count - 1
+                       WHERE poll_id=OLD.poll_id AND number=OLD.vote;
+                       UPDATE Polls SET
+                           num_votes = num_votes - 1,
+                           num_voters = num_voters - NOT EXISTS (
+                               SELECT 1 FROM Votes
+                               WHERE poll_id=OLD.poll_id
+                               AND voter=OLD.voter)
+                       WHERE poll_id=OLD.poll_id;
+                   END""")
+
+
+def _create_ballots(cur):
+    """Version 5: Bitmask ballots with a single row per voter.
+    Polls created with BALLOT_STORAGE = 'bitmask' store the votes of each
+    voter as a bitmask of the selected options in Ballots instead of one
+    row per vote in Votes. Options are split into words of 63 options,
+    so polls with more options use one row per word. The triggers keep
+    VoteCounts and the counts in Polls up to date.
+    """
+    cur.execute("""ALTER TABLE Polls
+                   ADD COLUMN ballots integer NOT NULL DEFAULT 0""")
+    cur.execute("""CREATE TABLE Ballots (
+                   poll_id integer REFERENCES Polls (poll_id)
+                   ON DELETE CASCADE ON UPDATE NO ACTION,
+                   voter integer NOT NULL REFERENCES Voters (id),
+                   word integer NOT NULL,
+                   mask integer NOT NULL,
+                   PRIMARY KEY (poll_id, voter, word))
+                   WITHOUT ROWID""")
+    cur.execute("""CREATE TRIGGER Ballots_insert
+                   AFTER INSERT ON Ballots
+                   BEGIN
+                       UPDATE VoteCounts SET count = count
+                           + ((NEW.mask >> (number - NEW.word * 63)) & 1)
+                       WHERE poll_id=NEW.poll_id
+                       AND number >= NEW.word * 63
+                       AND number < (NEW.word + 1) * 63;
+                       UPDATE Polls SET
+                           num_votes = (SELECT SUM(count) FROM VoteCounts
+                                        WHERE poll_id=NEW.poll_id),
+                           num_voters = num_voters + NOT EXISTS (
+                               SELECT 1 FROM Ballots
+                               WHERE poll_id=NEW.poll_id
+                               AND voter=NEW.voter AND word!=NEW.word)
+                       WHERE poll_id=NEW.poll_id;
+                   END""")
+    cur.execute("""CREATE TRIGGER Ballots_update
+                   AFTER UPDATE OF mask ON Ballots
+                   BEGIN
+                       UPDATE VoteCounts SET count = count
+                           + ((NEW.mask >> (number - NEW.word * 63)) & 1)
+                           - ((OLD.mask >> (number - OLD.word * 63)) & 1)
+                       WHERE poll_id=NEW.poll_id
+                       AND number >= NEW.word * 63
+                       AND number < (NEW.word + 1) * 63;
+                       UPDATE Polls SET
+                           num_votes = (SELECT SUM(count) FROM VoteCounts
+                                        WHERE poll_id=NEW.poll_id)
+                       WHERE poll_id=NEW.poll_id;
+                   END""")
+    cur.execute("""CREATE TRIGGER Ballots_delete
+                   AFTER DELETE ON Ballots
+                   BEGIN
+                       UPDATE VoteCounts SET count = count
+                           - ((OLD.mask >> (number - OLD.word * 63)) & 1)
+                       WHERE poll_id=OLD.poll_id
+                       AND number >= OLD.word * 63
+                       AND number < (OLD.word + 1) * 63;
+                       UPDATE Polls SET
+                           num_votes = (SELECT SUM(count) FROM VoteCounts
+                                        WHERE poll_id=OLD.poll_id),
+                           num_voters = num_voters - NOT EXISTS (
+                               SELECT 1 FROM Ballots
+                               WHERE poll_id=OLD.poll_id
+                               AND voter=OLD.voter)
+                       WHERE poll_id=OLD.poll_id;
+                   END""")
+
+
+def _create_renders(cur):
+    """Version 6: Rendered messages of finished polls.
+    The message of a finished poll never changes, so it is stored once
+    for each locale and external base URL (see `formatters.format_poll`).
+    """
+    cur.execute("""CREATE TABLE Renders (
+                   poll_id integer REFERENCES Polls (poll_id)
+                   ON DELETE CASCADE ON UPDATE NO ACTION,
+                   locale text NOT NULL,
+                   base_url text NOT NULL,
+                   render text NOT NULL,
+                   PRIMARY KEY (poll_id, locale, base_url))
+                   WITHOUT ROWID""")
+
+
+def _create_poll_versions(cur):
+    """Version 7: A version of each poll that is incremented by every
+    change of the votes or the finished state (see `Poll.vote` and
+    `Poll.end`).
+    """
+    cur.execute("""ALTER TABLE Polls
+                   ADD COLUMN version integer NOT NULL DEFAULT 0""")
+
+
+def _create_cache(cur):
+    """Version 8: A cache that is shared by all server processes
+    (see `cache.DatabaseCache`).
+    """
+    cur.execute("""CREATE TABLE Cache (
+                   key text PRIMARY KEY,
+                   value text NOT NULL,
+                   expires real NOT NULL)
+                   WITHOUT ROWID""")
+
+
+def _key_renders_by_locale(cur):
+    """Version 9: Stored messages of finished polls only depend on the
+    locale. The external base URL is filled in for each response, so
+    requests with other Host headers do not add rows. The stored
+    messages are rendered again.
+    """
+    cur.execute("""DROP TABLE Renders""")
+    cur.execute("""CREATE TABLE Renders (
+                   poll_id integer REFERENCES Polls (poll_id)
+                   ON DELETE CASCADE ON UPDATE NO ACTION,
+                   locale text NOT NULL,
+                   render text NOT NULL,
+                   PRIMARY KEY (poll_id, locale))
+                   WITHOUT ROWID""")
+
+
+# Ordered list of all migrations. Never change or reorder existing entries,
+# only append new ones.
+MIGRATIONS = [
+    _create_tables,
+    _create_indexes,
+    _create_vote_counts,
+    _create_voters,
+    _create_ballots,
+    _create_renders,
+    _create_poll_versions,
+    _create_cache,
+    _key_renders_by_locale,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+# PRAGMAs applied to each new connection for the available values of the
+# DATABASE_PROFILE setting.
+PROFILES = {
+    # SQLite defaults: rollback journal and a full fsync on each commit
+    'default': {},
+    # Readers and the single writer do not block each other and commits
+    # still survive power loss.
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'busy_timeout': 10000,
+    },
+    # Commits only sync the WAL at checkpoints. A power loss might lose
+    # the last votes, but the database stays consistent.
+    'throughput': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 10000,
+        'cache_size': -16000,  # in KiB
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    },
+}
+
+
+def profile_pragmas():
+    """Returns the PRAGMAs of the configured DATABASE_PROFILE, updated with
+    the optional DATABASE_PRAGMAS setting.
+    """
+    name = getattr(settings, 'DATABASE_PROFILE', 'default')
+    try:
+        pragmas = dict(PROFILES[name])
+    except KeyError:
+        raise ValueError('Unknown DATABASE_PROFILE: {}'.format(name))
+    pragmas.update(getattr(settings, 'DATABASE_PRAGMAS', {}))
+    return pragmas
+
+
+def connect(database=None):
+    """Returns a new connection to `database` or the configured database.
+    Prefer `connection()`, which reuses pooled connections.
+    """
+    con = sqlite3.connect(
+        database or settings.DATABASE,
+        check_same_thread=False,
+        cached_statements=getattr(settings, 'DATABASE_CACHED_STATEMENTS',
+                                  128))
+    # votes replaced through ON CONFLICT REPLACE must fire the delete
+    # trigger that keeps VoteCounts up to date
+    con.execute("""PRAGMA recursive_triggers = ON""")
+    for pragma, value in profile_pragmas().items():
+        con.execute("""PRAGMA {} = {}""".format(pragma, value))
+    return con
+
+
+class ConnectionPool:
+    """A small pool of idle connections to a single database.
+    Reusing connections avoids reopening the database file and keeps
+    the prepared statement cache of each connection warm.
+    Connections may be handed to different threads over time but must
+    only be used by one thread at a time.
+    After a fork all idle connections of the parent are discarded.
+
+    Attributes
+    ----------
+    database:
+        Path of the database file.
+    size: int
+        Maximum number of idle connections kept open.
+    """
+    def __init__(self, database, size):
+        self.database = database
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # connections must not be shared with the parent process
+            self._idle = []
+            self._pid = os.getpid()
+
+    def acquire(self):
+        """Returns an idle connection or opens a new one."""
+        with self._lock:
+            self._check_fork()
+            if self._idle:
+                return self._idle.pop()
+        return connect(self.database)
+
+    def release(self, con):
+        """Returns the connection to the pool.
+        An unfinished transaction is rolled back. If the pool is full,
+        the connection is closed instead.
+        """
+        if con.in_transaction:
+            con.rollback()
+        with self._lock:
+            self._check_fork()
+            if len(self._idle) < self.size:
+                self._idle.append(con)
+                return
+        con.close()
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for con in idle:
+            con.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+def pool():
+    """Returns the connection pool of the configured database."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.database != settings.DATABASE:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(
+                settings.DATABASE,
+                getattr(settings, 'DATABASE_POOL_SIZE', 4))
+        return _pool
+
+
+def connection():
+    """Returns the database connection for the current context.
+    Inside the app context of an app set up with `init_app`, a pooled
+    connection is acquired on first use and released on teardown.
+    Otherwise (e.g. CLI commands or other apps), each thread keeps its
+    own connection, which is not taken from the pool and is closed with
+    the thread or when the configured database changes.
+    """
+    if has_app_context() and 'database' in current_app.extensions:
+        if 'db_connection' not in g:
+            g.db_connection = pool().acquire()
+        return g.db_connection
+
+    con = getattr(_local, 'connection', None)
+    if con is None or _local.database != settings.DATABASE \
+            or _local.pid != os.getpid():
+        if con is not None and _local.pid == os.getpid():
+            con.close()
+        con = connect()
+        _local.connection = con
+        _local.database = settings.DATABASE
+        _local.pid = os.getpid()
+    return con
+
+
+def release_connection(exception=None):
+    """Returns the connection of the current app context to the pool."""
+    con = g.pop('db_connection', None)
+    if con is not None:
+        pool().release(con)
+
+
+def init_app(app):
+    """Registers the connection teardown with the Flask app."""
+    app.extensions['database'] = pool
+    app.teardown_appcontext(release_connection)
+
+
+def schema_version(con):
+    """Returns the schema version of the database."""
+    return con.execute("""PRAGMA user_version""").fetchone()[0]
+
+
+@contextlib.contextmanager
+def transaction(con):
+    """Runs the block in a write transaction and yields a cursor.
+    The transaction is started with BEGIN IMMEDIATE, so the write lock is
+    taken before the first read and concurrent writers wait for each
+    other (up to the busy timeout) instead of failing when upgrading
+    their lock. The transaction is committed at the end of the block and
+    rolled back if an exception is raised or the commit fails, so the
+    connection is never left in a transaction.
+    """
+    cur = con.cursor()
+    cur.execute("""BEGIN IMMEDIATE""")
+    try:
+        yield cur
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+
+
+class GroupCommitter:
+    """Batches write operations of concurrent requests into a single
+    transaction, so many votes share one commit (and fsync).
+    A background thread collects all operations submitted within `window`
+    seconds after the first one and runs them in one transaction on its
+    own connection. `submit` only returns after that transaction was
+    committed, so callers can read their own writes afterwards.
+
+    Attributes
+    ----------
+    database:
+        Path of the database file.
+    window: float
+        Seconds to wait for further operations after the first one.
+    max_batch: int
+        Maximum number of operations per transaction.
+    batches: int
+        Number of committed transactions.
+    """
+    def __init__(self, database, window, max_batch=500, timeout=10):
+        self.database = database
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, operation, con=None):
+        """Runs `operation(cursor)` in the next batch and returns its result
+        once the batch is committed.
+        If the operation raises an exception, only its own changes are
+        rolled back and the exception is raised here.
+        If the background thread is not running, the operation runs in
+        its own transaction on `con` (or a new connection) instead.
+        If the operation was not started after `timeout` seconds, it is
+        cancelled and a TimeoutError is raised.
+        """
+        if not self._ensure_thread():
+            logger.error('Group commit thread is not running')
+            return self._run_directly(operation, con)
+        future = Future()
+        self._queue.put((operation, future))
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                raise
+        # the operation is already running, so it finishes soon
+        return future.result()
+
+    def _run_directly(self, operation, con):
+        own_connection = con is None
+        if own_connection:
+            con = connect(self.database)
+        try:
+            with transaction(con) as cur:
+                return operation(cur)
+        finally:
+            if own_connection:
+                con.close()
+
+    def _ensure_thread(self):
+        """Starts the background thread in a new process and returns
+        whether it is running.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # threads do not survive a fork
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(
+                    target=self._run, name='GroupCommitter', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+            return self._thread.is_alive()
+
+    def _next_batch(self):
+        batch = []
+        while not batch:
+            operation, future = self._queue.get()
+            # skips operations that were cancelled by `submit`
+            if future.set_running_or_notify_cancel():
+                batch.append((operation, future))
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                operation, future = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if future.set_running_or_notify_cancel():
+                batch.append((operation, future))
+        return batch
+
+    def _run(self):
+        con = None
+        while True:
+            batch = self._next_batch()
+            results = []
+            try:
+                if con is None:
+                    con = connect(self.database)
+                # a failed commit is rolled back by `transaction`
+                with transaction(con) as cur:
+                    for operation, future in batch:
+                        cur.execute("""SAVEPOINT operation""")
+                        try:
+                            results.append((future, operation(cur), None))
+                        except Exception as e:
+                            cur.execute("""ROLLBACK TO operation""")
+                            results.append((future, None, e))
+                        cur.execute("""RELEASE operation""")
+            except Exception as e:
+                logger.error('Group commit failed: %s', e)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            for future, result, exception in results:
+                if exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(result)
+
+
+_group_committer = None
+
+
+def group_committer():
+    """Returns the `GroupCommitter` of the configured database or None if
+    DATABASE_GROUP_COMMIT_MS is not set.
+    """
+    global _group_committer
+    window = getattr(settings, 'DATABASE_GROUP_COMMIT_MS', 0)
+    if not window:
+        return None
+    with _pool_lock:
+        if _group_committer is None \
+                or _group_committer.database != settings.DATABASE \
+                or _group_committer.window != window / 1000:
+            _group_committer = GroupCommitter(settings.DATABASE,
+                                              window / 1000)
+        return _group_committer
+
+
+def migrate(con, target=None):
+    """Applies all pending migrations up to the `target` version (default:
+    the latest) to the database.
+    The migrations run in a single write transaction, so concurrently
+    starting processes wait for each other and only one of them
+    upgrades the database.
+    Returns the number of applied migrations.
+    """
+    if target is None:
+        target = SCHEMA_VERSION
+    with transaction(con) as cur:
+        version = schema_version(con)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(
+                "Database schema version {} is newer than the supported "
+                "version {}".format(version, SCHEMA_VERSION))
+        for number, migration in enumerate(MIGRATIONS[version:target],
+                                           start=version + 1):
+            logger.info('Migrating database to version %i', number)
+            migration(cur)
+            cur.execute("""PRAGMA user_version = {}""".format(number))
+    return max(0, target - version)
+
+
+# Actual number of votes of the option in VoteOptions and the actual
+# number of voters of the poll in Polls, from both ballot storages.
+_ACTUAL_OPTION_COUNT = """(
+    SELECT COUNT(*) FROM Votes
+    WHERE Votes.poll_id=VoteOptions.poll_id
+    AND Votes.vote=VoteOptions.number) + (
+    SELECT COUNT(*) FROM Ballots
+    WHERE Ballots.poll_id=VoteOptions.poll_id
+    AND Ballots.word=VoteOptions.number / 63
+    AND (Ballots.mask >> (VoteOptions.number % 63)) & 1)"""
+_ACTUAL_NUM_VOTERS = """(
+    SELECT COUNT(DISTINCT voter) FROM Votes
+    WHERE Votes.poll_id=Polls.poll_id) + (
+    SELECT COUNT(DISTINCT voter) FROM Ballots
+    WHERE Ballots.poll_id=Polls.poll_id)"""
+
+
+def check_vote_counts(con):
+    """Returns the ids of all polls whose counts in VoteCounts or Polls
+    differ from the actual votes.
+    """
+    cur = con.cursor()
+    cur.execute("""SELECT poll_id FROM Polls
+                   WHERE num_voters != {num_voters}
+                   OR num_votes != (
+                       SELECT COALESCE(SUM({option_count}), 0)
+                       FROM VoteOptions
+                       WHERE VoteOptions.poll_id=Polls.poll_id)
+                   UNION
+                   SELECT VoteOptions.poll_id
+                   FROM VoteOptions LEFT JOIN VoteCounts
+                   ON VoteCounts.poll_id=VoteOptions.poll_id
+                   AND VoteCounts.number=VoteOptions.number
+                   WHERE VoteCounts.count IS NULL
+                   OR VoteCounts.count != {option_count}
+                   ORDER BY poll_id""".format(
+                       num_voters=_ACTUAL_NUM_VOTERS,
+                       option_count=_ACTUAL_OPTION_COUNT))
+    return [row[0] for row in cur.fetchall()]
+
+
+def rebuild_vote_counts(con):
+    """Recomputes VoteCounts and the vote and voter counts in Polls
+    from the Votes and Ballots tables.
+    """
+    with transaction(con) as cur:
+        cur.execute("""DELETE FROM VoteCounts""")
+        cur.execute("""INSERT INTO VoteCounts (poll_id, number, count)
+                       SELECT poll_id, number, {}
+                       FROM VoteOptions""".format(_ACTUAL_OPTION_COUNT))
+        cur.execute("""UPDATE Polls SET
+                       num_votes = (SELECT COALESCE(SUM(count), 0)
+                                    FROM VoteCounts
+                                    WHERE VoteCounts.poll_id=Polls.poll_id),
+                       num_voters = {},
+                       version = version + 1""".format(_ACTUAL_NUM_VOTERS))
+        # the stored messages of finished polls may show the old counts
+        cur.execute("""DELETE FROM Renders""")
+
+
+def clear_renders(con, poll_id=None):
+    """Deletes the stored messages of all finished polls or only of the
+    poll with `poll_id`. They are rendered again on the next request.
+    Returns the number of deleted messages.
+    """
+    with transaction(con) as cur:
+        if poll_id is None:
+            cur.execute("""DELETE FROM Renders""")
+        else:
+            cur.execute("""DELETE FROM Renders WHERE poll_id=?""",
+                        (poll_id,))
+        return cur.rowcount
+
+
+def convert_ballots(con):
+    """Moves the votes of all polls that store one row per vote into
+    bitmask ballots (see `Poll`). Returns the number of converted polls.
+    """
+    with transaction(con) as cur:
+        cur.execute("""SELECT poll_id FROM Polls WHERE ballots=0""")
+        polls = [row[0] for row in cur.fetchall()]
+        cur.execute("""INSERT INTO Ballots (poll_id, voter, word, mask)
+                       SELECT poll_id, voter, vote / 63,
+                              SUM(1 << (vote % 63))
+                       FROM Votes
+                       WHERE poll_id IN (SELECT poll_id FROM Polls
+                                         WHERE ballots=0)
+                       GROUP BY poll_id, voter, vote / 63""")
+        cur.execute("""DELETE FROM Votes
+                       WHERE poll_id IN (SELECT poll_id FROM Polls
+                                         WHERE ballots=0)""")
+        cur.execute("""UPDATE Polls SET ballots=1 WHERE ballots=0""")
+    return len(polls)
+
+
+def migrate_database():
+    """Migrates the configured database to the current schema version."""
+    con = connect()
+    try:
+        return migrate(con)
+    finally:
+        con.close()
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
+import json
 import os.path
 
-from flask import url_for
+from flask import request, url_for
 from flask_babel import force_locale, gettext as tr, ngettext
 
+from cache import LRUCache
 import settings
 from mattermost_api import resolve_usernames
 
 
+# Bounded cache of the messages of running polls, keyed by the poll id,
+# version, locale and external base URL (see `format_poll`).
+render_cache = LRUCache(getattr(settings, 'RENDER_CACHE_SIZE', 1024))
+
+
 def _is_superfluous(line):
     """
     Check if a description of an option is superfluous
@@ -62,17 +69,88 @@ def format_help(command, locale='en'):
 
 def format_poll(poll):
     """Returns the JSON representation of the given poll.
+    The representation of a finished poll never changes, so it is
+    stored in the database when it is rendered the first time and
+    reused afterwards (see `Poll.rendered`).
+    Run `flask --app app clear-renders` after changing the formatting.
+    The representation of a running poll is shared by all requests that
+    see the same version of the poll (see `render_cache`) and must not be
+    modified.
     """
-    with force_locale(poll.locale):
-        if poll.is_finished():
-            return _format_finished_poll(poll)
-        return _format_running_poll(poll)
+    state = poll.state()
+    base_url = request.url_root
+    if state.finished:
+        rendered = poll.rendered(poll.locale)
+        if rendered is None:
+            snapshot = poll.snapshot()
+            voters, resolved = _voter_names(poll)
+            with force_locale(poll.locale):
+                rendered = json.dumps(_format_finished_poll(
+                    poll, snapshot, voters, url=_stored_url))
+            if resolved:
+                poll.store_rendered(poll.locale, rendered)
+        # the stored render is shared by all Host headers, so its URLs are
+        # completed here (see `BASE_URL_PLACEHOLDER`)
+        host_url = json.dumps(request.host_url.rstrip('/'))[1:-1]
+        return json.loads(rendered.replace(
+            json.dumps(BASE_URL_PLACEHOLDER)[1:-1], host_url))
+
+    poll_dict = render_cache.get((poll.id, state.version, poll.locale,
+                                  base_url))
+    if poll_dict is None:
+        # somebody may have voted since `state`, so the render is cached
+        # with the version of the snapshot
+        snapshot = poll.snapshot()
+        voters, resolved = None, True
+        if not poll.secret and poll.bars:
+            voters, resolved = _voter_names(poll)
+        with force_locale(poll.locale):
+            poll_dict = _format_running_poll(poll, snapshot, voters)
+        if resolved:
+            render_cache.put((poll.id, snapshot.version, poll.locale,
+                              base_url), poll_dict)
+    return poll_dict
+
+
+# Stands for the external base URL in the stored messages of finished
+# polls, which are shared by all requests regardless of their Host header
+# (see `format_poll`). Poll messages do not contain NUL characters.
+BASE_URL_PLACEHOLDER = '\x00'
+
+
+def _external_url(endpoint, **values):
+    return url_for(endpoint, _external=True, **values)
+
+
+def _stored_url(endpoint, **values):
+    """Returns the URL of `endpoint` with `BASE_URL_PLACEHOLDER` instead
+    of the external base URL.
+    """
+    return BASE_URL_PLACEHOLDER + url_for(endpoint, **values)
 
 
-def _format_running_poll(poll):
+def _voter_names(poll):
+    """Returns the user names of the voters of each option of a public
+    poll (None for other polls) and whether all of them were resolved.
+    The user ids of all options are resolved at once.
+    """
+    if not poll.public:
+        return None, True
+    voters = poll.voters_by_option()
+    usernames = resolve_usernames(
+        [user_id for user_ids in voters for user_id in user_ids])
+    if usernames is None:
+        return [['<Failed to resolve usernames>'] if user_ids else []
+                for user_ids in voters], False
+    return [[usernames[user_id] for user_id in user_ids
+             if user_id in usernames]
+            for user_ids in voters], True
+
+
+def _format_running_poll(poll, snapshot, voters):
     fields = [{
         'short': False,
-        'value': tr("*Number of voters: {}*").format(poll.num_voters()),
+        'value': tr("*Number of voters: {}*").format(snapshot.num_voters),
         'title': ""
     }]
     if poll.public:
@@ -88,93 +166,161 @@ def _format_running_poll(poll):
             'value': tr("*You have {} votes*").format(poll.max_votes),
             'title': ""
         }]
+    attachment = {
+        'text': poll.message,
+        'actions': format_actions(poll, snapshot),
+        'fields': fields
+    }
     if not poll.secret and poll.bars:
-        votes = [
-            (vote, vote_id)
-            for vote_id, vote
-            in enumerate(poll.vote_options)
-            if poll.count_votes(vote_id) > 0
-        ]
+        votes = _displayed_votes(poll, snapshot)
 
         fields += [{
             'short': False,
             'title': vote,
-            'value': _format_vote_end_text(poll, vote_id)
+            'value': _format_vote_end_text(poll, snapshot, vote_id, voters)
         } for vote, vote_id in votes]
 
+        if votes and settings.BAR_STYLE == 'chart':
+            attachment['image_url'] = _chart_url(poll, snapshot)
+
     return {
         'response_type': 'in_channel',
-        'attachments': [{
-            'text': poll.message,
-            'actions': format_actions(poll),
-            'fields': fields
-        }]
+        'attachments': [attachment]
     }
 
 
-def _format_finished_poll(poll):
-    votes = [
+def _format_finished_poll(poll, snapshot, voters, url=_external_url):
+    votes = _displayed_votes(poll, snapshot)
+    chart = poll.bars and settings.BAR_STYLE == 'chart'
+
+    attachment = {
+        'text': poll.message,
+        'fields': [{
+            'short': False,
+            'value': tr("*Number of voters: {}*").format(
+                snapshot.num_voters),
+            'title': ""
+        }] + [{
+            'short': not poll.bars or chart,
+            'title': vote,
+            'value': _format_vote_end_text(poll, snapshot, vote_id, voters,
+                                           url)
+        } for vote, vote_id in votes]
+    }
+    if chart:
+        attachment['image_url'] = _chart_url(poll, snapshot, url)
+
+    return {
+        'response_type': 'in_channel',
+        'attachments': [attachment]
+    }
+
+
+def _displayed_votes(poll, snapshot):
+    """Returns the name and id of the options that are displayed with
+    their votes: all options of finished polls, only options with votes
+    otherwise.
+    """
+    return [
         (vote, vote_id)
         for vote_id, vote
         in enumerate(poll.vote_options)
+        if snapshot.finished or snapshot.count_votes(vote_id) > 0
     ]
 
-    return {
-        'response_type': 'in_channel',
-        'attachments': [{
-            'text': poll.message,
-            'fields': [{
-                'short': False,
-                'value': tr("*Number of voters: {}*").format(
-                    poll.num_voters()),
-                'title': ""
-            }] + [{
-                'short': not poll.bars,
-                'title': vote,
-                'value': _format_vote_end_text(poll, vote_id)
-            } for vote, vote_id in votes]
-        }]
-    }
+
+def _relative_votes(snapshot, vote_id):
+    """Returns the percentage of all votes that went to the option."""
+    if snapshot.num_votes != 0:
+        return 100*snapshot.count_votes(vote_id)/snapshot.num_votes
+    return 0.0
+
+
+def _bar_width(rel_vote_count):
+    """Returns the width in pixels of the bar of an option."""
+    bar_min_width = 2  # even 0% should show a tiny bar
+    return max(bar_min_width, int(450*rel_vote_count/100))
+
+
+def _chart_url(poll, snapshot, url=_external_url):
+    return url('send_chart', poll_id=poll.id, version=snapshot.version)
+
+
+def chart_bars(poll, snapshot):
+    """Returns the width in pixels and the label of each bar in the chart
+    image of the poll (see BAR_STYLE 'chart'). The chart shows the same
+    options as the message of the poll.
+    """
+    bars = []
+    for _, vote_id in _displayed_votes(poll, snapshot):
+        rel_vote_count = _relative_votes(snapshot, vote_id)
+        label = '{} ({:.1f}%)'.format(snapshot.count_votes(vote_id),
+                                      rel_vote_count)
+        bars.append((_bar_width(rel_vote_count), label))
+    return bars
+
+
+# eighths of a block, the last one is a full block
+BAR_BLOCKS = '▏▎▍▌▋▊▉█'
+BAR_EMOJIS = ('🟦', '⬜')
+
+
+def _format_text_bar(rel_vote_count):
+    """Returns a bar of BAR_TEXT_WIDTH characters for BAR_STYLE 'unicode'
+    or 'emoji'.
+    Unicode bars are as precise as an eighth of a character and are
+    rendered as code, so the bars of all options have the same width.
+    """
+    width = settings.BAR_TEXT_WIDTH
+    if settings.BAR_STYLE == 'emoji':
+        filled = round(width*rel_vote_count/100)
+        return BAR_EMOJIS[0]*filled + BAR_EMOJIS[1]*(width - filled)
+
+    # even 0% should show a tiny bar
+    eighths = max(1, round(8*width*rel_vote_count/100))
+    full, rest = divmod(eighths, 8)
+    bar = BAR_BLOCKS[-1]*full
+    if rest:
+        bar += BAR_BLOCKS[rest - 1]
+    return '`{}`'.format(bar.ljust(width))
 
 
-def _format_vote_end_text(poll, vote_id):
-    vote_count = poll.count_votes(vote_id)
-    total_votes = poll.num_votes()
-    if total_votes != 0:
-        rel_vote_count = 100*vote_count/total_votes
-    else:
-        rel_vote_count = 0.0
+def _format_vote_end_text(poll, snapshot, vote_id, voters,
+                          url=_external_url):
+    vote_count = snapshot.count_votes(vote_id)
+    rel_vote_count = _relative_votes(snapshot, vote_id)
 
     text = ''
 
-    if poll.bars:
-        bar_min_width = 2  # even 0% should show a tiny bar
-        bar_width = max(bar_min_width, int(450*rel_vote_count/100))
+    # with BAR_STYLE 'chart' all bars are in the image of the attachment
+    if poll.bars and settings.BAR_STYLE in ('unicode', 'emoji'):
+        text += _format_text_bar(rel_vote_count) + ' '
+    elif poll.bars and settings.BAR_STYLE != 'chart':
+        bar_width = _bar_width(rel_vote_count)
         if settings.BAR_IMG_URL:
             # resize the image with markdown (won't work in native apps though)
             text += '![Bar]({} ={}x25) '.format(settings.BAR_IMG_URL, bar_width)
         else:
             # send_img will dynamically create a correctly sized bar for us
             filename = "bar_{}.png".format(bar_width)
-            png_path = url_for('send_img', filename=filename, _external=True)
+            png_path = url('send_img', filename=filename)
             text += '![Bar]({}) '.format(png_path)
 
     votes = ngettext('%(num)d Vote', '%(num)d Votes', vote_count)
     text += '{} ({:.1f}%)'.format(votes, rel_vote_count)
 
-    if poll.public:
-        voters = resolve_usernames(poll.voters(vote_id))
-
-        if len(voters):
-            text += '\n' + ', '.join(voters)
+    if voters is not None and len(voters[vote_id]):
+        text += '\n' + ', '.join(voters[vote_id])
 
     return text
 
 
-def format_actions(poll):
+def format_actions(poll, snapshot=None):
     """Returns the JSON data of all available actions of the given poll.
     Additional to the options of the poll, a 'End Poll' action
     is appended.
+    The vote counts are taken from `snapshot` if given, otherwise a new
+    snapshot of the poll is fetched.
     The returned list looks similar to this:
     ```
     [{
@@ -199,6 +345,8 @@ def format_actions(poll):
     }]
     ```
     """
+    if snapshot is None:
+        snapshot = poll.snapshot()
     with force_locale(poll.locale):
         options = poll.vote_options
         name = "{name}"
@@ -206,7 +354,7 @@ def format_actions(poll):
             # display current number of votes
             name += " ({votes})"
         actions = [{
-            'name': name.format(name=vote, votes=poll.count_votes(vote_id)),
+            'name': name.format(name=vote, votes=snapshot.count_votes(vote_id)),
             'integration': {
                 'url': url_for('vote', _external=True),
                 'context': {
@@ -232,9 +380,10 @@ def format_user_vote(poll, user_id):
     """Returns the vote of the given user as a string.
        Example: 'Pizza ✓, Burger ✗, Extra Cheese ✓'"""
     string = ''
+    user_votes = poll.votes(user_id)
     for vote_id, vote in enumerate(poll.vote_options):
         string += vote
-        if vote_id in poll.votes(user_id):
+        if vote_id in user_votes:
             string += ' ✓'
         else:
             string += ' ✗'
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Minimal PNG encoder for the bar images and charts.
+
+Only 8 bit RGBA images without interlacing are written, which is all
+the bars need, so Pillow is not required to serve them.
+"""
+import struct
+import zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _chunk(chunk_type, data):
+    return (struct.pack('>I', len(data)) + chunk_type + data +
+            struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+
+def encode_png(width, height, rows):
+    """Returns the PNG data of an RGBA image.
+    `rows` is a sequence of `height` byte strings with 4 bytes (red,
+    green, blue, alpha) for each of the `width` pixels of the row.
+    """
+    if width < 1 or height < 1:
+        raise ValueError('Invalid image size: {}x{}'.format(width, height))
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    # each row starts with its filter type (0: none)
+    data = b''.join(b'\x00' + row for row in rows)
+    return (PNG_SIGNATURE +
+            _chunk(b'IHDR', header) +
+            _chunk(b'IDAT', zlib.compress(data, 9)) +
+            _chunk(b'IEND', b''))
+
+
+def solid_png(width, height, color):
+    """Returns the PNG data of an image filled with the RGBA `color`."""
+    row = bytes(color) * width
+    return encode_png(width, height, [row] * height)
+
+
+# 3x5 pixel glyphs of the characters in the labels of a chart
+_GLYPHS = {
+    '0': ('111', '101', '101', '101', '111'),
+    '1': ('010', '110', '010', '010', '111'),
+    '2': ('111', '001', '111', '100', '111'),
+    '3': ('111', '001', '111', '001', '111'),
+    '4': ('101', '101', '111', '001', '001'),
+    '5': ('111', '100', '111', '001', '111'),
+    '6': ('111', '100', '111', '101', '111'),
+    '7': ('111', '001', '001', '001', '001'),
+    '8': ('111', '101', '111', '101', '111'),
+    '9': ('111', '101', '111', '001', '111'),
+    '.': ('000', '000', '000', '000', '010'),
+    '%': ('101', '001', '010', '100', '101'),
+    '(': ('001', '010', '010', '010', '001'),
+    ')': ('100', '010', '010', '010', '100'),
+    ' ': ('000', '000', '000', '000', '000'),
+}
+GLYPH_WIDTH = 3
+GLYPH_HEIGHT = 5
+
+
+def label_width(label, scale):
+    """Returns the width in pixels of `label` in a chart."""
+    return len(label) * (GLYPH_WIDTH + 1) * scale
+
+
+def chart_png(bars, bar_height, gap, color, label_color, scale=2):
+    """Returns the PNG data of a horizontal bar chart.
+
+    Parameters
+    ----------
+    bars: list of (int, str)
+        The width in pixels and the label of each bar from top to bottom.
+        Labels may only contain digits, spaces and the characters '.%()'.
+    bar_height: int
+        Height of each bar in pixels.
+    gap: int
+        Pixels between two bars and between the longest bar and the
+        labels.
+    color, label_color: tuple of int
+        RGBA colour of the bars and of the labels. The background is
+        transparent.
+    scale: int
+        Size of a pixel of the label glyphs in pixels.
+    """
+    if not bars:
+        raise ValueError('A chart needs at least one bar')
+    max_bar = max(width for width, _ in bars)
+    label_x = max_bar + gap
+    width = label_x + max(label_width(label, scale) for _, label in bars)
+    height = len(bars) * bar_height + (len(bars) - 1) * gap
+    pixels = bytearray(width * height * 4)
+    bar_color = bytes(color)
+    text_color = bytes(label_color) * scale
+
+    for index, (bar_width, label) in enumerate(bars):
+        top = index * (bar_height + gap)
+        for y in range(top, top + bar_height):
+            start = y * width * 4
+            pixels[start:start + bar_width * 4] = bar_color * bar_width
+
+        label_top = top + (bar_height - GLYPH_HEIGHT * scale) // 2
+        for char_index, char in enumerate(label):
+            left = label_x + label_width(label[:char_index], scale)
+            for glyph_y, glyph_row in enumerate(_GLYPHS[char]):
+                for glyph_x, pixel in enumerate(glyph_row):
+                    if pixel != '1':
+                        continue
+                    x = left + glyph_x * scale
+                    for dy in range(scale):
+                        y = label_top + glyph_y * scale + dy
+                        start = (y * width + x) * 4
+                        pixels[start:start + scale * 4] = text_color
+
+    row_size = width * 4
+    return encode_png(width, height,
+                      [bytes(pixels[y * row_size:(y + 1) * row_size])
+                       for y in range(height)])
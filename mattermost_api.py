@@ -1,36 +1,224 @@
 # -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
-import requests
+import os
+import threading
+import time
 
+from flask import g, has_app_context
+
+from cache import DatabaseCache
 import settings
 
 logger = logging.getLogger('flask.app')
 
 
-def get_user(user_id):
-    """Return the json data of the user."""
-    if not settings.MATTERMOST_PA_TOKEN:
-        return {}
+class CircuitBreaker:
+    """Stops calling a failing server for a while.
+    After `threshold` consecutive failures the breaker opens and no calls
+    are allowed for `reset_timeout` seconds. Then a single trial call is
+    allowed: if it succeeds the breaker closes again, otherwise it stays
+    open for another `reset_timeout` seconds.
+    """
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns whether a call is allowed."""
+        with self._lock:
+            if self._opened is None:
+                return True
+            if time.monotonic() - self._opened < self.reset_timeout:
+                return False
+            # half-open: allow a single trial call
+            self._opened = time.monotonic()
+            return True
+
+    def is_open(self):
+        """Returns whether calls are currently blocked."""
+        with self._lock:
+            return self._opened is not None
+
+    def record_success(self):
+        """Closes the breaker after a successful call."""
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+
+    def record_failure(self):
+        """Counts a failed call and opens the breaker after `threshold`
+        consecutive failures.
+        """
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                if self._opened is None:
+                    logger.warning('Mattermost API unavailable, pausing '
+                                   'requests for %s seconds',
+                                   self.reset_timeout)
+                self._opened = time.monotonic()
+
+    def reset(self):
+        """Closes the breaker."""
+        self.record_success()
+
+
+breaker = CircuitBreaker(getattr(settings, 'MATTERMOST_BREAKER_THRESHOLD', 5),
+                         getattr(settings, 'MATTERMOST_BREAKER_RESET', 30))
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
 
+def session():
+    """Returns the HTTP session of the current process.
+    The session keeps up to MATTERMOST_POOL_SIZE connections to the
+    Mattermost server alive and retries requests which were answered
+    with 502, 503 or 504 up to MATTERMOST_RETRIES times. Failed
+    connections and timeouts are not retried, so an unreachable server
+    costs at most MATTERMOST_TIMEOUT seconds per request. A server that
+    keeps answering with these status codes may take up to
+    (MATTERMOST_RETRIES + 1) * MATTERMOST_TIMEOUT seconds plus the
+    backoff between the retries (MATTERMOST_RETRY_BACKOFF doubled for
+    each further retry). Retry-After headers are ignored to keep this
+    bound.
+    A forked process creates a new session instead of sharing the
+    connections of its parent.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            # imported on first use, which keeps the start of the server fast
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=getattr(settings, 'MATTERMOST_RETRIES', 2),
+                connect=0,
+                read=0,
+                backoff_factor=getattr(settings,
+                                       'MATTERMOST_RETRY_BACKOFF', 0.1),
+                status_forcelist=(502, 503, 504),
+                # all requests only read data
+                allowed_methods=frozenset(['GET', 'POST']),
+                respect_retry_after_header=False,
+                raise_on_status=False)
+            pool_size = getattr(settings, 'MATTERMOST_POOL_SIZE', 10)
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=pool_size,
+                                  max_retries=retry)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session_pid = os.getpid()
+        return _session
+
+
+def _request(method, path, **kwargs):
+    """Sends a request to the Mattermost API and returns the response.
+    Returns None if the server is unavailable: the request failed, timed
+    out after MATTERMOST_TIMEOUT seconds, answered with a server error or
+    the circuit breaker is open.
+    """
+    if not breaker.allow():
+        return None
+    import requests
+
+    header = {'Authorization': 'Bearer ' + settings.MATTERMOST_PA_TOKEN}
+    url = settings.MATTERMOST_URL + path
     try:
-        header = {'Authorization': 'Bearer ' + settings.MATTERMOST_PA_TOKEN}
-        url = settings.MATTERMOST_URL + '/api/v4/users/' + user_id
+        r = getattr(session(), method)(
+            url, headers=header,
+            timeout=getattr(settings, 'MATTERMOST_TIMEOUT', 3), **kwargs)
+    except requests.RequestException as e:
+        logger.error('Mattermost API request failed: %s', str(e))
+        breaker.record_failure()
+        return None
+    if not r.ok and r.status_code >= 500:
+        logger.error('Mattermost API request failed: %s', r.status_code)
+        breaker.record_failure()
+        return None
+    breaker.record_success()
+    return r
+
+
+# Users, team roles and usernames, shared by all server processes.
+# Unknown users are cached for USER_CACHE_NEGATIVE_TTL seconds.
+user_cache = DatabaseCache(getattr(settings, 'USER_CACHE_TTL', 300),
+                           getattr(settings, 'USER_CACHE_NEGATIVE_TTL', 60))
+
 
-        r = requests.get(url, headers=header)
+def _memoized(key, lookup):
+    """Returns the result of `lookup()`, which is called at most once per
+    `key` in the current request (Flask app context).
+    """
+    if not has_app_context():
+        return lookup()
+    if 'mattermost_lookups' not in g:
+        g.mattermost_lookups = {}
+    lookups = g.mattermost_lookups
+    if key not in lookups:
+        lookups[key] = lookup()
+    return lookups[key]
+
+
+def _get_user(user_id):
+    """Returns the json data of the user, {} for unknown users or None if
+    the server is unavailable.
+    Each user is looked up at most once per request.
+    """
+    key = 'user:' + user_id
+    return _memoized(key, lambda: _fetch_user(key, user_id))
+
+
+def _fetch_user(key, user_id):
+    """Returns the user from `user_cache` or the Mattermost API
+    (see `_get_user`).
+    """
+    user = user_cache.get(key)
+    if user is not None:
+        return user
+
+    try:
+        r = _request('get', '/api/v4/users/' + user_id)
+        if r is None:
+            return None
         if r.ok:
-            return json.loads(r.text)
+            user = json.loads(r.text)
+            user_cache.put(key, user)
+            return user
+        user_cache.put(key, {}, negative=True)
     except KeyError as e:
         logger.error(e)
     return {}
 
 
-def user_locale(user_id):
-    """Return the locale of the user with the given user_id."""
+def get_user(user_id):
+    """Return the json data of the user."""
+    if not settings.MATTERMOST_PA_TOKEN:
+        return {}
+
+    return _get_user(user_id) or {}
+
+
+def user_locale(user_id, fallback="en"):
+    """Return the locale of the user with the given user_id.
+    If the server is unavailable, `fallback` is returned instead
+    (e.g. the locale of the poll).
+    """
     if not settings.MATTERMOST_PA_TOKEN:
         return "en"
 
-    user = get_user(user_id)
+    user = _get_user(user_id)
+    if user is None:
+        return fallback
     if 'locale' in user:
         locale = user['locale']
         if locale:
@@ -40,7 +228,9 @@ def user_locale(user_id):
 
 
 def is_admin_user(user_id):
-    """Return whether the user is an admin."""
+    """Return whether the user is an admin.
+    Denied if the server is unavailable.
+    """
 
     user = get_user(user_id)
     if 'roles' in user:
@@ -50,37 +240,101 @@ def is_admin_user(user_id):
 
 
 def is_team_admin(user_id, team_id):
-    """Return whether the user is an admin in the given team."""
+    """Return whether the user is an admin in the given team.
+    Denied if the server is unavailable.
+    """
     if not settings.MATTERMOST_PA_TOKEN:
         return False
 
-    try:
-        header = {'Authorization': 'Bearer ' + settings.MATTERMOST_PA_TOKEN}
-        url = settings.MATTERMOST_URL + '/api/v4/teams/' + team_id + '/members/' + user_id
+    key = 'team_member:{}:{}'.format(team_id, user_id)
+    roles = _memoized(key, lambda: _fetch_team_roles(key, user_id, team_id))
+    return roles is not None and 'team_admin' in roles
+
 
-        r = requests.get(url, headers=header)
+def _fetch_team_roles(key, user_id, team_id):
+    """Returns the roles of the user in the team, '' if the user is no
+    member or None if the server is unavailable.
+    """
+    roles = user_cache.get(key)
+    if roles is not None:
+        return roles
+
+    try:
+        r = _request('get', '/api/v4/teams/' + team_id + '/members/' + user_id)
+        if r is None:
+            return None
         if r.ok:
             roles = json.loads(r.text)['roles']
-            return 'team_admin' in roles
+            user_cache.put(key, roles)
+            return roles
+        user_cache.put(key, '', negative=True)
     except KeyError as e:
         logger.error(e)
 
-    return False
+    return ''
+
+
+def _resolve_usernames_chunk(user_ids):
+    """Returns a dict of the user id -> user name of the given users or
+    None if the request failed.
+    """
+    try:
+        r = _request('post', '/api/v4/users/ids', json=user_ids)
+        if r is not None and r.ok:
+            return {user["id"]: user["username"]
+                    for user in json.loads(r.text)}
+    except Exception as e:
+        logger.error('Username query failed: %s', str(e))
+
+    return None
 
 
 def resolve_usernames(user_ids):
-    """Resolve the list of user ids to list of user names."""
+    """Resolve the user ids to user names.
+    Returns a dict of user id -> user name or None if a request failed or
+    the server is unavailable.
+    Duplicate ids are only requested once and cached user names are not
+    requested at all. The ids are split into chunks of
+    USERNAME_CHUNK_SIZE ids that are requested concurrently by up to
+    USERNAME_WORKERS threads.
+    """
+    user_ids = sorted(set(user_ids))
     if len(user_ids) == 0:
-        return []
+        return {}
 
-    try:
-        header = {'Authorization': 'Bearer ' + settings.MATTERMOST_PA_TOKEN}
-        url = settings.MATTERMOST_URL + '/api/v4/users/ids'
+    cached = user_cache.get_many('username:' + user_id
+                                 for user_id in user_ids)
+    usernames = {key[len('username:'):]: username
+                 for key, username in cached.items()}
+    user_ids = [user_id for user_id in user_ids if user_id not in usernames]
+    if not user_ids:
+        return usernames
 
-        r = requests.post(url, headers=header, json=user_ids)
-        if r.ok:
-            return [user["username"] for user in json.loads(r.text)]
-    except Exception as e:
-        logger.error('Username query failed: %s', str(e))
+    resolved = _resolve_usernames(user_ids)
+    if resolved is None:
+        return None
+    user_cache.put_many({'username:' + user_id: username
+                         for user_id, username in resolved.items()})
+    usernames.update(resolved)
+    return usernames
+
+
+def _resolve_usernames(user_ids):
+    """Requests the user names of the sorted, unique `user_ids` (see
+    `resolve_usernames`).
+    """
+    chunk_size = max(1, getattr(settings, 'USERNAME_CHUNK_SIZE', 100))
+    chunks = [user_ids[i:i + chunk_size]
+              for i in range(0, len(user_ids), chunk_size)]
+    if len(chunks) == 1:
+        return _resolve_usernames_chunk(chunks[0])
 
-    return ['<Failed to resolve usernames>']
+    workers = min(len(chunks), getattr(settings, 'USERNAME_WORKERS', 4))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_resolve_usernames_chunk, chunks))
+    if None in results:
+        return None
+    usernames = {}
+    for result in results:
+        usernames.update(result)
+    return usernames
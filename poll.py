@@ -1,7 +1,10 @@
 import sqlite3
+from collections import namedtuple
 
 from flask_babel import force_locale, gettext as tr
 
+from cache import LRUCache
+import database
 import settings
 
 
@@ -15,48 +18,75 @@ class InvalidPollError(Exception):
     pass
 
 
-def init_database(con):
-    """Initializes the database. Is automatically called the first time a Poll
-    is created."""
-    cur = con.cursor()
-    cur.execute("""PRAGMA user_version = 1""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS Polls (
-                   poll_id integer PRIMARY KEY,
-                   creator text NOT NULL,
-                   message text NOT NULL,
-                   locale text NOT NULL,
-                   finished integer NOT NULL,
-                   secret integer NOT NULL,
-                   public integer NOT NULL,
-                   max_votes integer NOT NULL,
-                   bars integer NOT NULL)""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS VoteOptions (
-                   poll_id integer REFERENCES Polls (poll_id)
-                   ON DELETE CASCADE ON UPDATE NO ACTION,
-                   number integer NOT NULL,
-                   name text NOT NULL)""")
-    cur.execute("""CREATE TABLE IF NOT EXISTS Votes (
-                   poll_id integer REFERENCES Polls (poll_id)
-                   ON DELETE CASCADE ON UPDATE NO ACTION,
-                   voter text NOT NULL,
-                   vote integer NOT NULL,
-                   CONSTRAINT single_vote UNIQUE
-                   (poll_id, voter, vote) ON CONFLICT REPLACE)""")
-    con.commit()
-
-    cur.execute("""PRAGMA table_info(Polls)""")
-    if 'bars' not in (c[1] for c in cur.fetchall()):
-        print("Outdated database version detected, adding 'bars' column.")
-        cur.execute("""ALTER TABLE Polls
-                       ADD COLUMN bars integer NOT NULL DEFAULT 0""")
-        con.commit()
-
-    cur.execute("""PRAGMA table_info(Polls)""")
-    if 'locale' not in (c[1] for c in cur.fetchall()):
-        print("Outdated database version detected, adding 'locale' column.")
-        cur.execute("""ALTER TABLE Polls
-                       ADD COLUMN locale text NOT NULL DEFAULT "en" """)
-        con.commit()
+class PollSnapshot(namedtuple('PollSnapshot', ['finished', 'counts',
+                                               'num_votes', 'num_voters',
+                                               'version'])):
+    """Immutable state of a poll's tally at a single point in time.
+
+    Attributes
+    ----------
+    finished: boolean
+        Whether the poll was already ended.
+    counts: tuple of int
+        Number of votes for each option, indexed by `vote_id`.
+        None if the snapshot was taken with `Poll.state`.
+    num_votes: int
+        The total number of votes.
+    num_voters: int
+        The total number of users which voted.
+    version: int
+        Incremented by every change of the votes or the finished state.
+        Two snapshots of a poll with the same version are equal.
+    """
+    __slots__ = ()
+
+    def count_votes(self, vote_id):
+        """Returns the number of votes for the given option.
+        If the vote_id does not exists, 0 is returned.
+        """
+        if 0 <= vote_id < len(self.counts):
+            return self.counts[vote_id]
+        return 0
+
+
+def _voter_key(cur, user_id):
+    """Returns the integer key of the Mattermost user id in Voters.
+    Unknown users are added.
+    """
+    cur.execute("""SELECT id FROM Voters WHERE mm_user_id=?""", (user_id,))
+    row = cur.fetchone()
+    if row:
+        return row[0]
+    cur.execute("""INSERT INTO Voters (mm_user_id) VALUES (?)""", (user_id,))
+    return cur.lastrowid
+
+
+# Number of options stored in the bitmask of a single Ballots row
+BITS_PER_WORD = 63
+
+
+def _decode_ballot(masks):
+    """Returns the sorted `vote_id`s of the (word, mask) pairs of a ballot."""
+    votes = []
+    for word, mask in masks:
+        votes += [word * BITS_PER_WORD + bit
+                  for bit in range(BITS_PER_WORD) if mask >> bit & 1]
+    return sorted(votes)
+
+
+def _encode_ballot(votes):
+    """Returns a dict of word -> mask for the given `vote_id`s."""
+    masks = {}
+    for vote_id in votes:
+        word, bit = divmod(vote_id, BITS_PER_WORD)
+        masks[word] = masks.get(word, 0) | 1 << bit
+    return masks
+
+
+# Bounded cache of the poll attributes that never change after creation
+# (see `Poll.load`).
+metadata_cache = LRUCache(getattr(settings, 'POLL_CACHE_SIZE', 1024),
+                          getattr(settings, 'POLL_CACHE_TTL', 3600))
 
 
 class Poll:
@@ -64,6 +94,9 @@ class Poll:
     options.
     Each user has one vote and can change it until the poll is ended.
     Internally each Poll is saved in a database.
+    Depending on the BALLOT_STORAGE setting at creation, the votes are
+    stored as one row per vote (Votes) or as a bitmask of the selected
+    options per voter (Ballots).
 
     Attributes
     ----------
@@ -87,15 +120,28 @@ class Poll:
     max_votes: int
         Number of votes each user has.
     """
-    def __init__(self, connection, id):
+    # attributes that never change after the poll was created
+    _metadata_attributes = ('creator_id', 'message', 'locale',
+                            'vote_options', 'secret', 'public',
+                            'max_votes', 'bars')
+
+    def __init__(self, connection, id, metadata=None):
         """Loads the poll with `id` from the database connection.
+        If `metadata` (see `metadata`) is given, only the mutable state
+        is read from the database.
         Use `create` or `load` instead.
+        The database must already be migrated (see `database.migrate`).
         """
-        init_database(connection)
         self.connection = connection
         self.connection.row_factory = sqlite3.Row
         self.id = id
 
+        if metadata is not None:
+            for name, value in zip(self._metadata_attributes, metadata):
+                setattr(self, name, value)
+            self.vote_options = list(self.vote_options)
+            return
+
         try:
             self.vote_options = []
             cur = self.connection.cursor()
@@ -131,9 +177,7 @@ class Poll:
         """Creates a new poll without any votes.
         Empty vote_options will be replaced by ['Yes', 'No'].
         """
-        con = sqlite3.connect(settings.DATABASE)
-        init_database(con)
-        cur = con.cursor()
+        con = database.connection()
 
         if not vote_options:
             with force_locale(locale):
@@ -141,45 +185,99 @@ class Poll:
         # clamp to 1 to len(vote_options)
         max_votes = max(1, min(max_votes, len(vote_options)))
 
-        cur.execute("""INSERT INTO Polls
-                       (creator, message, locale, finished,
-                        secret, public, max_votes, bars) VALUES
-                       (?, ?, ?, ?, ?, ?, ?, ?)""",
-                    (creator_id, message, locale, False,
-                     secret, public, max_votes, bars))
-        id = cur.lastrowid
-        for number, name in enumerate(vote_options):
-            cur.execute("""INSERT INTO VoteOptions
-                           (poll_id, name, number) VALUES
-                           (?, ?, ?)""",
-                        (id, name, number))
-        con.commit()
-        return cls(con, id)
+        with database.transaction(con) as cur:
+            cur.execute("""INSERT INTO Polls
+                           (creator, message, locale, finished,
+                            secret, public, max_votes, bars, ballots) VALUES
+                           (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                        (creator_id, message, locale, False,
+                         secret, public, max_votes, bars,
+                         getattr(settings, 'BALLOT_STORAGE',
+                                 'rows') == 'bitmask'))
+            id = cur.lastrowid
+            cur.executemany("""INSERT INTO VoteOptions
+                               (poll_id, name, number) VALUES
+                               (?, ?, ?)""",
+                            [(id, name, number)
+                             for number, name in enumerate(vote_options)])
+        poll = cls(con, id)
+        metadata_cache.put(id, poll.metadata())
+        return poll
 
     @classmethod
     def load(cls, id):
         """Loads a poll from the database.
         Raise a InvalidPollError if no poll with that id
         exists.
+        The immutable attributes are taken from `metadata_cache` if
+        possible.
+        """
+        con = database.connection()
+        metadata = metadata_cache.get(id)
+        poll = cls(con, id, metadata)
+        if metadata is None:
+            metadata_cache.put(id, poll.metadata())
+        return poll
+
+    def metadata(self):
+        """Returns the attributes that never change after the poll was
+        created as a tuple.
         """
-        con = sqlite3.connect(settings.DATABASE)
-        return cls(con, id)
+        return tuple(
+            tuple(self.vote_options) if name == 'vote_options'
+            else getattr(self, name)
+            for name in self._metadata_attributes
+        )
+
+    def state(self):
+        """Returns a `PollSnapshot` without the vote counts of the options
+        (`counts` is None). This needs a single query.
+        """
+        cur = self.connection.cursor()
+        cur.execute("""SELECT finished, num_votes, num_voters, version
+                       FROM Polls WHERE poll_id=?""",
+                    (self.id,))
+        finished, num_votes, num_voters, version = cur.fetchone()
+        return PollSnapshot(finished == 1, None,
+                            num_votes, num_voters, version)
+
+    def snapshot(self):
+        """Returns a `PollSnapshot` with the finished state, the number of
+        votes of every option and the number of voters.
+        Everything is read in a single query, so the snapshot is
+        consistent even if somebody votes at the same time. The number of
+        queries does not depend on the number of options, so formatters
+        should prefer this over the individual counters.
+        """
+        cur = self.connection.cursor()
+        counts = [0] * len(self.vote_options)
+        cur.execute("""SELECT finished, num_votes, num_voters, version,
+                              number, count
+                       FROM Polls LEFT JOIN VoteCounts USING (poll_id)
+                       WHERE poll_id=?""",
+                    (self.id,))
+        rows = cur.fetchall()
+        for _, _, _, _, vote_id, count in rows:
+            if vote_id is not None and 0 <= vote_id < len(counts):
+                counts[vote_id] = count
+
+        finished, num_votes, num_voters, version = rows[0][:4]
+        return PollSnapshot(finished == 1, tuple(counts),
+                            num_votes, num_voters, version)
 
     def num_votes(self):
         """Returns the total number of votes."""
         cur = self.connection.cursor()
-        cur.execute("""SELECT * FROM Votes WHERE poll_id=?""",
+        cur.execute("""SELECT num_votes FROM Polls WHERE poll_id=?""",
                     (self.id,))
-        return len(cur.fetchall())
+        return cur.fetchone()[0]
 
     def num_voters(self):
         """Returns the total number of users which voted."""
         cur = self.connection.cursor()
-        cur.execute("""SELECT COUNT(vote) FROM Votes
-                       WHERE poll_id=?
-                       GROUP BY voter""",
+        cur.execute("""SELECT num_voters FROM Polls WHERE poll_id=?""",
                     (self.id,))
-        return len(cur.fetchall())
+        return cur.fetchone()[0]
 
     def count_votes(self, vote_id):
         """Returns the number of votes for the given option.
@@ -187,28 +285,73 @@ class Poll:
         If the vote_id does not exists, 0 is returned.
         """
         cur = self.connection.cursor()
-        cur.execute("""SELECT * FROM Votes
-                       WHERE poll_id=? AND vote=?""",
+        cur.execute("""SELECT count FROM VoteCounts
+                       WHERE poll_id=? AND number=?""",
                     (self.id, vote_id))
-        return len(cur.fetchall())
+        row = cur.fetchone()
+        return row[0] if row else 0
 
     def voters(self, vote_id):
-        """Returns all voters for a given vote_id."""
+        """Returns all voters for a given vote_id, sorted by user id.
+        Both ballot storages return them in the same order.
+        """
+        word, bit = divmod(vote_id, BITS_PER_WORD)
         cur = self.connection.cursor()
-        cur.execute("""SELECT voter FROM Votes
-                       WHERE poll_id=? AND vote=?""",
-                    (self.id, vote_id))
+        cur.execute("""SELECT mm_user_id FROM Votes
+                       JOIN Voters ON Voters.id=Votes.voter
+                       WHERE poll_id=? AND vote=?
+                       UNION ALL
+                       SELECT mm_user_id FROM Ballots
+                       JOIN Voters ON Voters.id=Ballots.voter
+                       WHERE poll_id=? AND word=? AND (mask >> ?) & 1
+                       ORDER BY mm_user_id""",
+                    (self.id, vote_id, self.id, word, bit))
         return [voter[0] for voter in cur.fetchall()]
 
+    def voters_by_option(self):
+        """Returns a list with the voters of each option, indexed by
+        `vote_id`. Unlike `voters` this needs a constant number of
+        queries.
+        """
+        voters = [[] for _ in self.vote_options]
+        cur = self.connection.cursor()
+        cur.execute("""SELECT vote, mm_user_id FROM Votes
+                       JOIN Voters ON Voters.id=Votes.voter
+                       WHERE poll_id=?""",
+                    (self.id,))
+        for vote_id, user_id in cur.fetchall():
+            if 0 <= vote_id < len(voters):
+                voters[vote_id].append(user_id)
+        cur.execute("""SELECT word, mask, mm_user_id FROM Ballots
+                       JOIN Voters ON Voters.id=Ballots.voter
+                       WHERE poll_id=?""",
+                    (self.id,))
+        for word, mask, user_id in cur.fetchall():
+            for vote_id in _decode_ballot([(word, mask)]):
+                if vote_id < len(voters):
+                    voters[vote_id].append(user_id)
+        return voters
+
     def votes(self, user_id):
         """Returns a list of `vote_id`s the user voted for.
         The `vote_id` is the index of an option in the vote_options.
         """
         cur = self.connection.cursor()
+        cur.execute("""SELECT id FROM Voters WHERE mm_user_id=?""",
+                    (user_id,))
+        row = cur.fetchone()
+        if not row:
+            return []
+        voter = row[0]
+
         cur.execute("""SELECT vote FROM Votes
                        WHERE poll_id=? AND voter=?""",
-                    (self.id, user_id))
-        return [v[0] for v in cur.fetchall()]
+                    (self.id, voter))
+        votes = [v[0] for v in cur.fetchall()]
+        cur.execute("""SELECT word, mask FROM Ballots
+                       WHERE poll_id=? AND voter=?""",
+                    (self.id, voter))
+        return votes + _decode_ballot(cur.fetchall())
 
     def vote(self, user_id, vote_id):
         """Places a vote of the given user.
@@ -218,44 +361,128 @@ class Poll:
         Each user only has a single vote.
         When voting multiple times for different options, only the
         last vote will remain.
+        The vote is placed in a single write transaction, so concurrent
+        votes of the same user cannot exceed `max_votes` and no vote is
+        placed after the poll was ended.
+        With group commit enabled, the transaction is shared with votes
+        of concurrent requests (see `database.GroupCommitter`).
         """
-        if self.is_finished():
+        committer = database.group_committer()
+        if committer is not None:
+            committer.submit(lambda cur: self._vote(cur, user_id, vote_id),
+                             self.connection)
+            return
+        with database.transaction(self.connection) as cur:
+            self._vote(cur, user_id, vote_id)
+
+    def _vote(self, cur, user_id, vote_id):
+        """Places a vote inside of an already started transaction."""
+        cur.execute("""SELECT finished, ballots FROM Polls WHERE poll_id=?""",
+                    (self.id,))
+        finished, ballots = cur.fetchone()
+        if finished == 1:
             return
         if vote_id < 0 or vote_id >= len(self.vote_options):
             raise IndexError('Invalid vote_id: {}'.format(vote_id))
+        # rolled back together with the vote if no vote is left
+        cur.execute("""UPDATE Polls SET version = version + 1
+                       WHERE poll_id=?""",
+                    (self.id,))
 
-        cur = self.connection.cursor()
+        voter = _voter_key(cur, user_id)
+        if ballots:
+            self._vote_ballot(cur, voter, vote_id)
+            return
+
+        # unvote
+        cur.execute("""DELETE FROM Votes
+                       WHERE poll_id=? AND voter=? AND vote=?""",
+                    (self.id, voter, vote_id))
+        if cur.rowcount:
+            return
+
+        if self.max_votes == 1:
+            # remove the other vote automatically
+            cur.execute("""DELETE FROM Votes
+                           WHERE poll_id=? AND voter=?""",
+                        (self.id, voter))
+        # only insert if the user hasn't used all his votes yet
+        cur.execute("""INSERT INTO Votes (poll_id, voter, vote)
+                       SELECT ?, ?, ?
+                       WHERE (SELECT COUNT(*) FROM Votes
+                              WHERE poll_id=? AND voter=?) < ?""",
+                    (self.id, voter, vote_id,
+                     self.id, voter, self.max_votes))
+        if not cur.rowcount:
+            raise NoMoreVotesError()
+
+    def _vote_ballot(self, cur, voter, vote_id):
+        """Toggles the vote in the bitmask ballot of the voter."""
+        cur.execute("""SELECT word, mask FROM Ballots
+                       WHERE poll_id=? AND voter=?""",
+                    (self.id, voter))
+        masks = dict(cur.fetchall())
+        votes = _decode_ballot(masks.items())
 
-        votes = self.votes(user_id)
         if vote_id in votes:
             # unvote
-            cur.execute("""DELETE FROM Votes
-                        WHERE poll_id=? AND voter=? AND vote=?""",
-                        (self.id, user_id, vote_id))
+            votes.remove(vote_id)
+        elif len(votes) < self.max_votes:
+            votes.append(vote_id)
+        elif self.max_votes == 1:
+            # replace the other vote automatically
+            votes = [vote_id]
         else:
-            # check if the user hasn't used all his votes yet
-            if len(votes) >= self.max_votes:
-                if self.max_votes == 1:
-                    # remove the other vote automatically
-                    cur.execute("""DELETE FROM Votes
-                                   WHERE poll_id=? AND voter=?""",
-                                (self.id, user_id))
-                else:
-                    raise NoMoreVotesError()
-            cur.execute("""INSERT INTO Votes
-                           (poll_id, voter, vote) VALUES
-                           (?, ?, ?)""",
-                        (self.id, user_id, vote_id))
-        self.connection.commit()
+            raise NoMoreVotesError()
+
+        new_masks = _encode_ballot(votes)
+        for word in set(masks) | set(new_masks):
+            old_mask = masks.get(word, 0)
+            new_mask = new_masks.get(word, 0)
+            if old_mask == new_mask:
+                continue
+            if not new_mask:
+                cur.execute("""DELETE FROM Ballots
+                               WHERE poll_id=? AND voter=? AND word=?""",
+                            (self.id, voter, word))
+            elif not old_mask:
+                cur.execute("""INSERT INTO Ballots (poll_id, voter, word, mask)
+                               VALUES (?, ?, ?, ?)""",
+                            (self.id, voter, word, new_mask))
+            else:
+                cur.execute("""UPDATE Ballots SET mask=?
+                               WHERE poll_id=? AND voter=? AND word=?""",
+                            (new_mask, self.id, voter, word))
+
+    def rendered(self, locale):
+        """Returns the stored message of the finished poll for the given
+        locale or None if there is none.
+        """
+        cur = self.connection.cursor()
+        cur.execute("""SELECT render FROM Renders
+                       WHERE poll_id=? AND locale=?""",
+                    (self.id, locale))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def store_rendered(self, locale, render):
+        """Stores the message of the finished poll for the given locale
+        (see `rendered`).
+        """
+        with database.transaction(self.connection) as cur:
+            cur.execute("""INSERT OR REPLACE INTO Renders
+                           (poll_id, locale, render) VALUES (?, ?, ?)""",
+                        (self.id, locale, render))
 
     def end(self):
         """Ends the poll.
         After the poll ends, voting is not possible anymore.
+        Ending a finished poll again does not change it.
         """
-        cur = self.connection.cursor()
-        cur.execute("""UPDATE Polls SET finished=1 WHERE poll_id=?""",
-                    (self.id,))
-        self.connection.commit()
+        with database.transaction(self.connection) as cur:
+            cur.execute("""UPDATE Polls SET finished=1, version = version + 1
+                           WHERE poll_id=? AND finished=0""",
+                        (self.id,))
 
     def is_finished(self):
         """Return True if the poll is finished or False otherwise."""
@@ -1,6 +1,8 @@
 import os.path
 import pytest
 
+import database
+import mattermost_api
 import settings
 
 
@@ -9,3 +11,11 @@ def clear_database():
     assert settings.TEST_SETTINGS
     if os.path.exists(settings.DATABASE):
         os.remove(settings.DATABASE)
+    database.migrate_database()
+
+
+@pytest.fixture(autouse=True)
+def reset_mattermost_api():
+    # the cache is kept in the test database across tests
+    mattermost_api.user_cache.clear()
+    mattermost_api.breaker.reset()
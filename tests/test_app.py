@@ -1,6 +1,8 @@
 # pylint: disable=missing-docstring
 import pytest
 import app
+import database
+import mattermost_api
 
 from test_utils import force_settings
 
@@ -137,3 +139,68 @@ def test_empty_slash_command():
     assert args.progress
     assert not args.public
     assert args.bars
+
+
+def test_migrate_command(tmp_path):
+    runner = app.app.test_cli_runner()
+    with force_settings(DATABASE=str(tmp_path / 'new.db')):
+        result = runner.invoke(args=['migrate'])
+        assert result.exit_code == 0
+        assert 'from schema version 0 to {}'.format(
+            database.SCHEMA_VERSION) in result.output
+
+        result = runner.invoke(args=['migrate'])
+        assert result.exit_code == 0
+        assert 'already at schema version {}'.format(
+            database.SCHEMA_VERSION) in result.output
+
+
+def test_check_counts_command():
+    runner = app.app.test_cli_runner()
+    result = runner.invoke(args=['check-counts'])
+    assert result.exit_code == 0
+    assert 'consistent' in result.output
+
+
+def test_convert_ballots_command(mocker):
+    mocker.patch('database.convert_ballots', return_value=3)
+    result = app.app.test_cli_runner().invoke(args=['convert-ballots'])
+    assert result.exit_code == 0
+    assert 'Converted 3 poll(s)' in result.output
+
+
+def test_clear_renders_command(mocker):
+    clear = mocker.patch('database.clear_renders', return_value=2)
+    runner = app.app.test_cli_runner()
+    result = runner.invoke(args=['clear-renders'])
+    assert result.exit_code == 0
+    assert 'Deleted 2 stored message(s)' in result.output
+    assert clear.call_args[0][1] is None
+
+    result = runner.invoke(args=['clear-renders', '7'])
+    assert result.exit_code == 0
+    assert clear.call_args[0][1] == 7
+
+
+def test_clear_user_cache_command():
+    mattermost_api.user_cache.put('user:user1', {})
+    runner = app.app.test_cli_runner()
+    result = runner.invoke(args=['clear-user-cache', '--expired'])
+    assert result.exit_code == 0
+    assert 'Deleted 0 cached entries' in result.output
+    result = runner.invoke(args=['clear-user-cache'])
+    assert 'Deleted 1 cached entries' in result.output
+
+
+def test_export_bars_command(tmp_path):
+    directory = tmp_path / 'bars'
+    result = app.app.test_cli_runner().invoke(
+        args=['export-bars', str(directory)])
+    assert result.exit_code == 0
+    assert 'Exported 999 bar images' in result.output
+
+    files = sorted(path.name for path in directory.iterdir())
+    assert len(files) == 999
+    assert 'bar_1.png' in files and 'bar_999.png' in files
+    assert (directory / 'bar_20.png').read_bytes() == \
+        app.render_bar('bar_20.png').png
@@ -0,0 +1,125 @@
+# pylint: disable=missing-docstring
+import sqlite3
+from cache import LRUCache, DatabaseCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1  # 'b' is now the least recently used
+    cache.put('c', 3)
+
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_ttl(mocker):
+    now = [100.0]
+    mocker.patch('cache.time.monotonic', new=lambda: now[0])
+
+    cache = LRUCache(10, ttl=5)
+    cache.put('a', 1)
+    now[0] += 5
+    assert cache.get('a') == 1
+    now[0] += 1
+    assert cache.get('a', 'expired') == 'expired'
+    assert len(cache) == 0
+
+
+def test_disabled():
+    cache = LRUCache(0)
+    cache.put('a', 1)
+    assert cache.get('a') is None
+
+
+def test_stats():
+    cache = LRUCache(10)
+    cache.put('a', 1)
+    cache.get('a')
+    cache.get('a')
+    cache.get('b')
+    cache.pop('a')
+    cache.get('a')
+
+    stats = cache.stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 2
+    assert stats['hit_rate'] == 0.5
+    assert stats['size'] == 0
+
+    cache.clear()
+    assert cache.stats()['hits'] == 0
+
+
+def test_database_cache(mocker):
+    now = [100.0]
+    mocker.patch('cache.time.time', new=lambda: now[0])
+
+    cache = DatabaseCache(ttl=10, negative_ttl=2)
+    cache.clear()
+    assert cache.get('a') is None
+    cache.put('a', {'locale': 'de'})
+    cache.put('b', {}, negative=True)
+    cache.put_many({'c': 'x', 'd': ['y']})
+
+    # shared with other instances (processes)
+    other = DatabaseCache(ttl=10)
+    assert other.get('a') == {'locale': 'de'}
+    assert other.get_many(['b', 'c', 'd', 'e']) == {
+        'b': {}, 'c': 'x', 'd': ['y']}
+
+    now[0] += 5
+    assert cache.get('b', 'expired') == 'expired'
+    assert cache.get('a') == {'locale': 'de'}
+    assert cache.stats() == {'size': 3, 'hits': 1, 'misses': 2,
+                             'hit_rate': 1 / 3}
+
+    now[0] += 6
+    assert cache.get('a') is None
+    assert cache.clear(expired_only=True) == 4
+    assert cache.stats()['hits'] == 0
+
+
+def test_database_cache_purges_expired(mocker):
+    now = [100.0]
+    mocker.patch('cache.time.time', new=lambda: now[0])
+
+    cache = DatabaseCache(ttl=10, purge_interval=30)
+    cache.clear()
+    cache.put_many({'a': 1, 'b': 2})
+
+    cache._purge_thread.join()
+
+    now[0] += 20
+    cache.put('c', 3)  # too early, the expired entries are kept
+    assert DatabaseCache(ttl=10).clear(expired_only=True) == 2
+    cache.put_many({'a': 1, 'b': 2})
+
+    now[0] += 15
+    cache.put('d', 4)
+    cache._purge_thread.join()
+    assert cache.clear(expired_only=True) == 0
+    assert cache.get_many(['a', 'b', 'c', 'd']) == {'d': 4}
+
+
+def test_database_cache_write_failure(mocker):
+    cache = DatabaseCache(ttl=10)
+    cache.clear()
+    mocker.patch('cache.database.transaction',
+                 side_effect=sqlite3.OperationalError('database is locked'))
+    warning = mocker.patch('cache.logger.warning')
+
+    cache.put('a', 1)
+    cache._purge_thread.join()
+    assert warning.call_count == 2
+    assert cache.get('a') is None
+
+
+def test_database_cache_disabled():
+    cache = DatabaseCache(ttl=0)
+    cache.put('a', 1)
+    assert cache.get('a') is None
+    assert cache.stats()['size'] == 0
@@ -0,0 +1,416 @@
+# pylint: disable=missing-docstring
+from concurrent import futures
+import sqlite3
+import time
+import pytest
+import database
+
+
+def test_migrate_empty():
+    con = sqlite3.connect(':memory:')
+    assert database.schema_version(con) == 0
+
+    assert database.migrate(con) == database.SCHEMA_VERSION
+    assert database.schema_version(con) == database.SCHEMA_VERSION
+    assert not con.in_transaction
+
+    tables = [row[0] for row in con.execute(
+        """SELECT name FROM sqlite_master WHERE type='table'""")]
+    assert 'Polls' in tables
+    assert 'VoteOptions' in tables
+    assert 'Votes' in tables
+
+    # already up to date
+    assert database.migrate(con) == 0
+
+
+def test_migrate_newer_version():
+    con = sqlite3.connect(':memory:')
+    con.execute("""PRAGMA user_version = {}""".format(
+        database.SCHEMA_VERSION + 1))
+
+    with pytest.raises(RuntimeError):
+        database.migrate(con)
+    assert not con.in_transaction
+
+
+def test_migrate_failure_rolls_back(monkeypatch):
+    def broken_migration(cur):
+        cur.execute("""CREATE TABLE Spam (eggs integer)""")
+        raise sqlite3.OperationalError('broken')
+
+    monkeypatch.setattr(database, 'MIGRATIONS',
+                        database.MIGRATIONS + [broken_migration])
+    monkeypatch.setattr(database, 'SCHEMA_VERSION',
+                        database.SCHEMA_VERSION + 1)
+
+    con = sqlite3.connect(':memory:')
+    with pytest.raises(sqlite3.OperationalError):
+        database.migrate(con)
+    assert database.schema_version(con) == 0
+    tables = [row[0] for row in con.execute(
+        """SELECT name FROM sqlite_master WHERE type='table'""")]
+    assert not tables
+
+
+def test_transaction_commit_failure_rolls_back():
+    con = sqlite3.connect(':memory:')
+    con.execute("""PRAGMA foreign_keys = ON""")
+    con.execute("""CREATE TABLE Spam (eggs integer PRIMARY KEY)""")
+    con.execute("""CREATE TABLE Ham (spam integer REFERENCES Spam
+                   DEFERRABLE INITIALLY DEFERRED)""")
+    con.commit()
+
+    # the deferred foreign key is only checked by the commit
+    with pytest.raises(sqlite3.IntegrityError):
+        with database.transaction(con) as cur:
+            cur.execute("""INSERT INTO Ham VALUES (1)""")
+    assert not con.in_transaction
+    assert con.execute("""SELECT COUNT(*) FROM Ham""").fetchone()[0] == 0
+
+    with database.transaction(con) as cur:
+        cur.execute("""INSERT INTO Spam VALUES (1)""")
+    assert not con.in_transaction
+
+
+def test_pool_reuses_connections(tmp_path):
+    pool = database.ConnectionPool(str(tmp_path / 'pool.db'), 2)
+    con = pool.acquire()
+    pool.release(con)
+    assert pool.acquire() is con
+
+
+def test_pool_size(tmp_path):
+    pool = database.ConnectionPool(str(tmp_path / 'pool.db'), 1)
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first is not second
+
+    pool.release(first)
+    pool.release(second)
+    with pytest.raises(sqlite3.ProgrammingError):
+        second.execute("""SELECT 1""")  # closed because the pool was full
+    assert pool.acquire() is first
+
+
+def test_pool_rolls_back_on_release(tmp_path):
+    pool = database.ConnectionPool(str(tmp_path / 'pool.db'), 1)
+    con = pool.acquire()
+    con.execute("""CREATE TABLE Spam (eggs integer)""")
+    con.commit()
+    con.execute("""INSERT INTO Spam VALUES (1)""")
+    assert con.in_transaction
+
+    pool.release(con)
+    assert not con.in_transaction
+    assert con.execute("""SELECT COUNT(*) FROM Spam""").fetchone()[0] == 0
+
+
+def test_pool_discards_connections_after_fork(tmp_path):
+    pool = database.ConnectionPool(str(tmp_path / 'pool.db'), 1)
+    con = pool.acquire()
+    pool.release(con)
+
+    pool._pid = -1  # pretend we are in a forked child
+    assert pool.acquire() is not con
+
+
+def test_connection_per_app_context():
+    import app
+
+    with app.app.app_context():
+        con = database.connection()
+        assert database.connection() is con
+    assert con in database.pool()._idle
+
+    with app.app.app_context():
+        assert database.connection() is con
+
+
+def test_connection_outside_of_app():
+    from flask import Flask
+
+    idle = list(database.pool()._idle)
+    main = database.connection()
+    # an app without `init_app` never releases pooled connections
+    with Flask(__name__).app_context():
+        assert database.connection() is main
+    assert database.pool()._idle == idle
+
+
+def test_connection_closed_on_database_change(monkeypatch, tmp_path):
+    old = database.connection()
+    monkeypatch.setattr(database.settings, 'DATABASE',
+                        str(tmp_path / 'other.db'))
+    new = database.connection()
+    assert new is not old
+    with pytest.raises(sqlite3.ProgrammingError):
+        old.execute("""SELECT 1""")
+    assert new not in database.pool()._idle
+
+
+def test_connection_per_thread():
+    import threading
+
+    main = database.connection()
+    assert database.connection() is main
+
+    others = []
+    thread = threading.Thread(
+        target=lambda: others.append(database.connection()))
+    thread.start()
+    thread.join()
+    assert others[0] is not main
+
+
+def pragma(con, name):
+    return con.execute("""PRAGMA {}""".format(name)).fetchone()[0]
+
+
+def test_profile_default(tmp_path):
+    con = database.connect(str(tmp_path / 'profile.db'))
+    assert pragma(con, 'journal_mode') == 'delete'
+
+
+def test_profile_throughput(monkeypatch, tmp_path):
+    monkeypatch.setattr(database.settings, 'DATABASE_PROFILE',
+                        'throughput', raising=False)
+    con = database.connect(str(tmp_path / 'profile.db'))
+    assert pragma(con, 'journal_mode') == 'wal'
+    assert pragma(con, 'synchronous') == 1  # NORMAL
+    assert pragma(con, 'busy_timeout') == 10000
+    assert pragma(con, 'cache_size') == -16000
+
+
+def test_profile_custom_pragmas(monkeypatch, tmp_path):
+    monkeypatch.setattr(database.settings, 'DATABASE_PROFILE',
+                        'durable', raising=False)
+    monkeypatch.setattr(database.settings, 'DATABASE_PRAGMAS',
+                        {'busy_timeout': 250}, raising=False)
+    con = database.connect(str(tmp_path / 'profile.db'))
+    assert pragma(con, 'journal_mode') == 'wal'
+    assert pragma(con, 'synchronous') == 2  # FULL
+    assert pragma(con, 'busy_timeout') == 250
+
+
+def test_profile_invalid(monkeypatch, tmp_path):
+    monkeypatch.setattr(database.settings, 'DATABASE_PROFILE',
+                        'fast', raising=False)
+    with pytest.raises(ValueError):
+        database.connect(str(tmp_path / 'profile.db'))
+
+
+INSERT_POLL = """INSERT INTO Polls
+                 (poll_id, creator, message, locale, finished,
+                  secret, public, max_votes, bars)
+                 VALUES (1, 'user0', 'Spam?', 'en', 0, 0, 0, 2, 0)"""
+
+
+def test_rebuild_vote_counts():
+    con = sqlite3.connect(':memory:')
+    database.migrate(con)
+    con.execute(INSERT_POLL)
+    con.executemany("""INSERT INTO VoteOptions VALUES (1, ?, ?)""",
+                    [(0, 'Yes'), (1, 'No')])
+    con.executemany("""INSERT INTO Votes VALUES (1, ?, ?)""",
+                    [(1, 0), (1, 1), (2, 1)])
+    con.commit()
+    assert database.check_vote_counts(con) == []
+
+    # introduce drift
+    con.execute("""UPDATE VoteCounts SET count=5 WHERE number=0""")
+    con.execute("""UPDATE Polls SET num_voters=0""")
+    con.commit()
+    assert database.check_vote_counts(con) == [1]
+
+    database.rebuild_vote_counts(con)
+    assert database.check_vote_counts(con) == []
+    assert con.execute("""SELECT count FROM VoteCounts
+                          ORDER BY number""").fetchall() == [(1,), (2,)]
+    assert con.execute("""SELECT num_votes, num_voters
+                          FROM Polls""").fetchone() == (3, 2)
+
+
+def test_replaced_votes_are_counted(tmp_path):
+    con = database.connect(str(tmp_path / 'replace.db'))
+    database.migrate(con)
+    con.execute(INSERT_POLL)
+    con.execute("""INSERT INTO VoteOptions VALUES (1, 0, 'Yes')""")
+    # the second insert replaces the first one because of single_vote
+    con.execute("""INSERT INTO Votes VALUES (1, 1, 0)""")
+    con.execute("""INSERT INTO Votes VALUES (1, 1, 0)""")
+    con.commit()
+    assert database.check_vote_counts(con) == []
+
+
+def test_group_commit(tmp_path):
+    import threading
+
+    path = str(tmp_path / 'group.db')
+    con = database.connect(path)
+    con.execute("""CREATE TABLE Spam (eggs integer UNIQUE)""")
+    con.commit()
+
+    committer = database.GroupCommitter(path, window=0.05)
+
+    def insert(value):
+        def operation(cur):
+            cur.execute("""INSERT INTO Spam VALUES (?)""", (value,))
+            return value
+        return operation
+
+    results = []
+    errors = []
+
+    def submit(value):
+        try:
+            results.append(committer.submit(insert(value)))
+        except sqlite3.IntegrityError as e:
+            errors.append(e)
+
+    # 10 is inserted twice, only one of them may fail
+    threads = [threading.Thread(target=submit, args=(v,))
+               for v in list(range(20)) + [10]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == list(range(20))
+    assert len(errors) == 1
+    assert committer.batches < 21
+    assert con.execute("""SELECT COUNT(*) FROM Spam""").fetchone()[0] == 20
+
+
+def spam_database(path):
+    con = database.connect(path)
+    con.execute("""CREATE TABLE Spam (eggs integer PRIMARY KEY)""")
+    con.execute("""CREATE TABLE Ham (spam integer REFERENCES Spam
+                   DEFERRABLE INITIALLY DEFERRED)""")
+    con.commit()
+    return con
+
+
+def insert(table, value):
+    def operation(cur):
+        cur.execute("""INSERT INTO {} VALUES (?)""".format(table), (value,))
+        return value
+    return operation
+
+
+def test_group_commit_failure(monkeypatch, tmp_path):
+    path = str(tmp_path / 'group.db')
+    con = spam_database(path)
+    connect = database.connect
+
+    def connect_with_foreign_keys(database):
+        con = connect(database)
+        con.execute("""PRAGMA foreign_keys = ON""")
+        return con
+
+    monkeypatch.setattr(database, 'connect', connect_with_foreign_keys)
+    committer = database.GroupCommitter(path, window=0)
+
+    # the deferred foreign key fails the commit of the whole batch
+    with pytest.raises(sqlite3.IntegrityError):
+        committer.submit(insert('Ham', 1))
+    assert committer.submit(insert('Spam', 1)) == 1
+    assert committer.submit(insert('Ham', 1)) == 1
+    assert con.execute("""SELECT COUNT(*) FROM Ham""").fetchone()[0] == 1
+
+
+def test_group_commit_connect_failure(monkeypatch, tmp_path):
+    path = str(tmp_path / 'group.db')
+    con = spam_database(path)
+    connect = database.connect
+
+    def broken_connect(database):
+        raise sqlite3.OperationalError('unable to open database file')
+
+    monkeypatch.setattr(database, 'connect', broken_connect)
+    committer = database.GroupCommitter(path, window=0)
+    with pytest.raises(sqlite3.OperationalError):
+        committer.submit(insert('Spam', 1))
+
+    monkeypatch.setattr(database, 'connect', connect)
+    assert committer.submit(insert('Spam', 2)) == 2
+    assert con.execute("""SELECT eggs FROM Spam""").fetchall() == [(2,)]
+
+
+def test_group_commit_without_thread(tmp_path):
+    import threading
+
+    path = str(tmp_path / 'group.db')
+    con = spam_database(path)
+    committer = database.GroupCommitter(path, window=0)
+    committer._ensure_thread()
+    committer._thread = threading.Thread(target=lambda: None)
+    committer._thread.start()
+    committer._thread.join()
+
+    assert committer.submit(insert('Spam', 1), con) == 1
+    assert committer.submit(insert('Spam', 2)) == 2
+    assert committer.batches == 0
+    assert con.execute("""SELECT COUNT(*) FROM Spam""").fetchone()[0] == 2
+
+
+def test_group_commit_timeout(tmp_path):
+    import threading
+
+    path = str(tmp_path / 'group.db')
+    con = spam_database(path)
+    committer = database.GroupCommitter(path, window=0, timeout=0.1)
+    started = threading.Event()
+
+    def slow(cur):
+        started.set()
+        time.sleep(0.3)
+        return insert('Spam', 1)(cur)
+
+    thread = threading.Thread(target=committer.submit, args=(slow,))
+    thread.start()
+    started.wait()
+    with pytest.raises(futures.TimeoutError):
+        committer.submit(insert('Spam', 2))
+    thread.join()
+
+    # the cancelled operation is skipped
+    assert committer.submit(insert('Spam', 3)) == 3
+    assert con.execute("""SELECT eggs FROM Spam""").fetchall() == [(1,), (3,)]
+
+
+def test_group_committer_setting(monkeypatch):
+    assert database.group_committer() is None
+
+    monkeypatch.setattr(database.settings, 'DATABASE_GROUP_COMMIT_MS', 5,
+                        raising=False)
+    committer = database.group_committer()
+    assert committer.window == 0.005
+    assert database.group_committer() is committer
+
+
+def test_migrate_voters():
+    con = sqlite3.connect(':memory:')
+    assert database.migrate(con, target=3) == 3
+    assert database.schema_version(con) == 3
+    con.execute(INSERT_POLL)
+    con.executemany("""INSERT INTO VoteOptions VALUES (1, ?, ?)""",
+                    [(0, 'Yes'), (1, 'No')])
+    con.executemany("""INSERT INTO Votes VALUES (1, ?, ?)""",
+                    [('user0', 0), ('user0', 1), ('user1', 1)])
+    con.commit()
+
+    database.migrate(con)
+    assert con.execute("""SELECT COUNT(*) FROM Voters""").fetchone()[0] == 2
+    votes = con.execute("""SELECT mm_user_id, vote FROM Votes
+                           JOIN Voters ON Voters.id=Votes.voter
+                           ORDER BY mm_user_id, vote""").fetchall()
+    assert votes == [('user0', 0), ('user0', 1), ('user1', 1)]
+    assert database.check_vote_counts(con) == []
+
+    # the triggers are recreated for the new table
+    con.execute("""DELETE FROM Votes WHERE vote=1""")
+    con.commit()
+    assert con.execute("""SELECT num_votes, num_voters
+                          FROM Polls""").fetchone() == (1, 1)
+    assert database.check_vote_counts(con) == []
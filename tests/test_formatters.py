@@ -2,10 +2,15 @@
 import pytest
 import formatters as frmts
 import app
+import database
 from poll import Poll
 from test_utils import force_settings
 
 
+def resolve_usernames(user_ids):
+    return {user_id: user_id for user_id in user_ids}
+
+
 def default_img_url(rel_width):
     width = int(max(2, rel_width*450))
     return 'http://localhost:5005/img/bar_{}.png'.format(width)
@@ -65,7 +70,7 @@ def test_format_actions(votes, secret, exp_actions):
 
 
 def test_format_poll_running(mocker):
-    mocker.patch('formatters.resolve_usernames', new=lambda user_ids: user_ids)
+    mocker.patch('formatters.resolve_usernames', new=resolve_usernames)
 
     poll = Poll.create(
         creator_id='user0',
@@ -106,7 +111,7 @@ def test_format_poll_running(mocker):
 
 
 def test_format_poll_running_multi(mocker):
-    mocker.patch('formatters.resolve_usernames', new=lambda user_ids: user_ids)
+    mocker.patch('formatters.resolve_usernames', new=resolve_usernames)
 
     poll = Poll.create(
         creator_id='user0',
@@ -154,7 +159,7 @@ def test_format_poll_running_multi(mocker):
 
 
 def test_format_poll_running_public(mocker):
-    mocker.patch('formatters.resolve_usernames', new=lambda user_ids: user_ids)
+    mocker.patch('formatters.resolve_usernames', new=resolve_usernames)
 
     poll = Poll.create(
         creator_id='user0',
@@ -201,7 +206,7 @@ def test_format_poll_running_public(mocker):
 
 
 def test_format_poll_running_public_bars(mocker):
-    mocker.patch('formatters.resolve_usernames', new=lambda user_ids: user_ids)
+    mocker.patch('formatters.resolve_usernames', new=resolve_usernames)
 
     poll = Poll.create(
         creator_id='user0',
@@ -265,7 +270,7 @@ def test_format_poll_running_public_bars(mocker):
 
 
 def test_format_poll_running_secret(mocker):
-    mocker.patch('formatters.resolve_usernames', new=lambda user_ids: user_ids)
+    mocker.patch('formatters.resolve_usernames', new=resolve_usernames)
 
     poll = Poll.create(
         creator_id='user0',
@@ -313,7 +318,7 @@ def test_format_poll_running_secret(mocker):
 
 
 def test_format_poll_finished(mocker):
-    mocker.patch('formatters.resolve_usernames', new=lambda user_ids: user_ids)
+    mocker.patch('formatters.resolve_usernames', new=resolve_usernames)
 
     poll = Poll.create(
         creator_id='user0',
@@ -370,7 +375,7 @@ def test_format_poll_finished(mocker):
 
 
 def test_format_poll_finished_public(mocker):
-    mocker.patch('formatters.resolve_usernames', new=lambda user_ids: user_ids)
+    mocker.patch('formatters.resolve_usernames', new=resolve_usernames)
 
     poll = Poll.create(
         creator_id='user0',
@@ -426,7 +431,7 @@ def test_format_poll_finished_public(mocker):
 
 
 def test_format_poll_finished_bars(mocker):
-    mocker.patch('formatters.resolve_usernames', new=lambda user_ids: user_ids)
+    mocker.patch('formatters.resolve_usernames', new=resolve_usernames)
 
     poll = Poll.create(
         creator_id='user0',
@@ -484,7 +489,7 @@ def test_format_poll_finished_bars(mocker):
 
 
 def test_format_poll_finished_public_bars(mocker):
-    mocker.patch('formatters.resolve_usernames', new=lambda user_ids: user_ids)
+    mocker.patch('formatters.resolve_usernames', new=resolve_usernames)
 
     poll = Poll.create(
         creator_id='user0',
@@ -542,7 +547,7 @@ def test_format_poll_finished_public_bars(mocker):
 
 
 def test_format_poll_bars_absolute_url(mocker):
-    mocker.patch('formatters.resolve_usernames', new=lambda user_ids: user_ids)
+    mocker.patch('formatters.resolve_usernames', new=resolve_usernames)
 
     img_url = 'http://example.org/images/red_bar.png'
     with force_settings(BAR_IMG_URL=img_url):
@@ -573,6 +578,150 @@ def test_format_poll_bars_absolute_url(mocker):
             assert 'localhost' not in field['value']
 
 
+@pytest.mark.parametrize('num_options', [2, 20])
+def test_format_poll_constant_queries(mocker, num_options):
+    mocker.patch('formatters.resolve_usernames', new=resolve_usernames)
+
+    poll = Poll.create(
+        creator_id='user0',
+        message='Message',
+        vote_options=['Option {}'.format(i) for i in range(num_options)],
+        bars=True,
+    )
+    for voter in range(num_options):
+        poll.vote('user{}'.format(voter), voter)
+
+    statements = []
+    poll.connection.set_trace_callback(statements.append)
+    try:
+        with app.app.test_request_context(base_url='http://localhost:5005'):
+            frmts.format_poll(poll)
+    finally:
+        poll.connection.set_trace_callback(None)
+
+    assert len(statements) == 2
+
+
+def test_format_poll_running_shared(mocker):
+    mocker.patch('formatters.resolve_usernames', new=resolve_usernames)
+
+    poll = Poll.create(
+        creator_id='user0',
+        message='Message',
+        vote_options=['Sure', 'No'],
+    )
+    poll.vote('user0', 0)
+
+    with app.app.test_request_context(base_url='http://localhost:5005'):
+        poll_dict = frmts.format_poll(poll)
+
+    statements = []
+    poll.connection.set_trace_callback(statements.append)
+    try:
+        with app.app.test_request_context(base_url='http://localhost:5005'):
+            assert frmts.format_poll(poll) is poll_dict
+    finally:
+        poll.connection.set_trace_callback(None)
+    assert len(statements) == 1
+
+    poll.vote('user1', 1)
+    with app.app.test_request_context(base_url='http://localhost:5005'):
+        new_dict = frmts.format_poll(poll)
+    assert new_dict is not poll_dict
+    assert new_dict['attachments'][0]['actions'][1]['name'] == 'No (1)'
+
+
+def test_format_poll_finished_stored(mocker):
+    resolve = mocker.patch('formatters.resolve_usernames',
+                           side_effect=resolve_usernames)
+
+    poll = Poll.create(
+        creator_id='user0',
+        message='Message',
+        vote_options=['Sure', 'No'],
+        public=True,
+        bars=True,
+    )
+    poll.vote('user0', 0)
+    poll.vote('user1', 1)
+    poll.end()
+
+    with app.app.test_request_context(base_url='http://localhost:5005'):
+        poll_dict = frmts.format_poll(poll)
+    assert resolve.call_count == 1
+
+    statements = []
+    poll.connection.set_trace_callback(statements.append)
+    try:
+        with app.app.test_request_context(base_url='http://localhost:5005'):
+            assert frmts.format_poll(poll) == poll_dict
+    finally:
+        poll.connection.set_trace_callback(None)
+    assert resolve.call_count == 1
+    assert not any('VoteOptions' in s or 'Votes' in s for s in statements)
+
+    # all base URLs share the stored message
+    with app.app.test_request_context(base_url='http://example.org'):
+        other_dict = frmts.format_poll(poll)
+    assert resolve.call_count == 1
+    value = other_dict['attachments'][0]['fields'][1]['value']
+    assert '](http://example.org/img/bar_' in value
+    assert 'localhost' not in value
+    assert value == poll_dict['attachments'][0]['fields'][1]['value'] \
+        .replace('http://localhost:5005', 'http://example.org')
+    count = poll.connection.execute(
+        "SELECT COUNT(*) FROM Renders WHERE poll_id=?", (poll.id,))
+    assert count.fetchone()[0] == 1
+
+    database.clear_renders(poll.connection, poll.id)
+    assert poll.rendered(poll.locale) is None
+
+
+def test_format_poll_public_resolves_once(mocker):
+    resolve = mocker.patch('formatters.resolve_usernames',
+                           side_effect=resolve_usernames)
+
+    poll = Poll.create(
+        creator_id='user0',
+        message='Message',
+        vote_options=['Option {}'.format(i) for i in range(15)],
+        public=True,
+        max_votes=2,
+    )
+    for voter in range(15):
+        poll.vote('user{}'.format(voter), voter)
+        poll.vote('user{}'.format(voter), (voter + 1) % 15)
+    poll.end()
+
+    with app.app.test_request_context(base_url='http://localhost:5005'):
+        poll_dict = frmts.format_poll(poll)
+    assert resolve.call_count == 1
+    user_ids = sorted(resolve.call_args[0][0])
+    assert len(user_ids) == 30
+    fields = poll_dict['attachments'][0]['fields']
+    assert fields[1]['value'].endswith('\nuser0, user14')
+
+
+def test_format_poll_unresolved_not_stored(mocker):
+    mocker.patch('formatters.resolve_usernames', return_value=None)
+
+    poll = Poll.create(
+        creator_id='user0',
+        message='Message',
+        vote_options=['Sure', 'No'],
+        public=True,
+    )
+    poll.vote('user0', 0)
+    poll.end()
+
+    with app.app.test_request_context(base_url='http://localhost:5005'):
+        poll_dict = frmts.format_poll(poll)
+    fields = poll_dict['attachments'][0]['fields']
+    assert '<Failed to resolve usernames>' in fields[1]['value']
+    assert '<Failed' not in fields[2]['value']
+    assert poll.rendered(poll.locale) is None
+
+
 def test_vote_to_string_single():
     poll = Poll.create(
         creator_id='user0',
@@ -641,3 +790,127 @@ def test_format_help_remove_superfluous():
         assert '`--noprogress`' not in hlp
         assert '`--bars`' in hlp
         assert '`--nobars`' not in hlp
+
+
+def test_format_poll_chart(mocker):
+    mocker.patch('formatters.resolve_usernames', new=resolve_usernames)
+
+    with force_settings(BAR_STYLE='chart'):
+        poll = Poll.create(
+            creator_id='user0',
+            message='Message',
+            vote_options=['Sure', 'Maybe', 'No'],
+            bars=True,
+        )
+        poll.vote('user0', 0)
+        poll.vote('user1', 2)
+        poll.vote('user2', 2)
+
+        with app.app.test_request_context(base_url='http://localhost:5005'):
+            running = frmts.format_poll(poll)
+            version = poll.state().version
+            poll.end()
+            finished = frmts.format_poll(poll)
+
+    attachment = running['attachments'][0]
+    assert attachment['image_url'] == \
+        'http://localhost:5005/img/chart/{}/{}.png'.format(poll.id, version)
+    values = [field['value'] for field in attachment['fields'][1:]]
+    assert values == ['1 Vote (33.3%)', '2 Votes (66.7%)']
+    assert frmts.chart_bars(poll, poll.snapshot()._replace(
+        finished=False)) == [(150, '1 (33.3%)'), (300, '2 (66.7%)')]
+
+    attachment = finished['attachments'][0]
+    assert attachment['image_url'] == \
+        'http://localhost:5005/img/chart/{}/{}.png'.format(poll.id,
+                                                           version + 1)
+    assert all(field['short'] for field in attachment['fields'][1:])
+    assert all('![Bar]' not in field['value']
+               for field in attachment['fields'])
+    assert frmts.chart_bars(poll, poll.snapshot()) == [
+        (150, '1 (33.3%)'), (2, '0 (0.0%)'), (300, '2 (66.7%)')]
+
+
+@pytest.mark.parametrize('secret, bars', [(True, True), (False, False)])
+def test_format_poll_chart_hidden(secret, bars):
+    with force_settings(BAR_STYLE='chart'):
+        poll = Poll.create(
+            creator_id='user0',
+            message='Message',
+            vote_options=['Yes', 'No'],
+            secret=secret,
+            bars=bars,
+        )
+        poll.vote('user0', 0)
+
+        with app.app.test_request_context(base_url='http://localhost:5005'):
+            poll_dict = frmts.format_poll(poll)
+
+    assert 'image_url' not in poll_dict['attachments'][0]
+
+
+@pytest.mark.parametrize('style, expected', [
+    ('unicode', ['`███▍      ` 1 Vote (33.3%)',
+                 '`▏         ` 0 Votes (0.0%)',
+                 '`██████▋   ` 2 Votes (66.7%)']),
+    ('emoji', ['🟦🟦🟦⬜⬜⬜⬜⬜⬜⬜ 1 Vote (33.3%)',
+               '⬜⬜⬜⬜⬜⬜⬜⬜⬜⬜ 0 Votes (0.0%)',
+               '🟦🟦🟦🟦🟦🟦🟦⬜⬜⬜ 2 Votes (66.7%)']),
+])
+def test_format_poll_text_bars(style, expected):
+    with force_settings(BAR_STYLE=style):
+        poll = Poll.create(
+            creator_id='user0',
+            message='Message',
+            vote_options=['Sure', 'Maybe', 'No'],
+            bars=True,
+        )
+        poll.vote('user0', 0)
+        poll.vote('user1', 2)
+        poll.vote('user2', 2)
+        poll.end()
+
+        with app.app.test_request_context(base_url='http://localhost:5005'):
+            poll_dict = frmts.format_poll(poll)
+
+    attachment = poll_dict['attachments'][0]
+    assert 'image_url' not in attachment
+    assert [field['value'] for field in attachment['fields'][1:]] == expected
+
+
+@pytest.mark.parametrize('rel_vote_count, expected', [
+    (0, '`▏    `'),
+    (2.5, '`▏    `'),
+    (10, '`▌    `'),
+    (50, '`██▌  `'),
+    (97.5, '`████▉`'),
+    (100, '`█████`'),
+])
+def test_format_text_bar_precision(rel_vote_count, expected):
+    with force_settings(BAR_STYLE='unicode', BAR_TEXT_WIDTH=5):
+        assert frmts._format_text_bar(rel_vote_count) == expected
+
+
+def test_format_poll_vote_during_render(mocker):
+    poll = Poll.create(
+        creator_id='user0',
+        message='Message',
+        vote_options=['Yes', 'No'],
+        bars=True,
+    )
+    poll.vote('user0', 0)
+    old_state = poll.state()
+    poll.vote('user1', 0)  # after `format_poll` read the state
+    mocker.patch.object(poll, 'state', return_value=old_state)
+
+    with app.app.test_request_context(base_url='http://localhost:5005'):
+        poll_dict = frmts.format_poll(poll)
+
+    field = poll_dict['attachments'][0]['fields'][1]
+    assert '2 Votes (100.0%)' in field['value']
+    assert frmts.render_cache.get(
+        (poll.id, old_state.version, poll.locale,
+         'http://localhost:5005/')) is None
+    assert frmts.render_cache.get(
+        (poll.id, old_state.version + 1, poll.locale,
+         'http://localhost:5005/')) is poll_dict
@@ -0,0 +1,53 @@
+# pylint: disable=missing-docstring
+import io
+
+import PIL.Image
+import pytest
+
+from images import encode_png, solid_png, chart_png, label_width
+
+
+def test_solid_png():
+    png = solid_png(7, 3, (35, 137, 215, 255))
+    image = PIL.Image.open(io.BytesIO(png), formats=['PNG'])
+    assert image.size == (7, 3)
+    assert image.mode == 'RGBA'
+    assert {image.getpixel((x, y)) for x in range(7) for y in range(3)} \
+        == {(35, 137, 215, 255)}
+
+
+def test_encode_png_rows():
+    rows = [bytes([255, 0, 0, 255, 0, 0, 255, 128]),
+            bytes([0, 255, 0, 255, 0, 0, 0, 0])]
+    image = PIL.Image.open(io.BytesIO(encode_png(2, 2, rows)))
+    assert [image.getpixel((x, y)) for y in range(2) for x in range(2)] \
+        == [(255, 0, 0, 255), (0, 0, 255, 128),
+            (0, 255, 0, 255), (0, 0, 0, 0)]
+
+
+@pytest.mark.parametrize('width, height', [(0, 1), (1, 0)])
+def test_encode_png_invalid_size(width, height):
+    with pytest.raises(ValueError):
+        solid_png(width, height, (0, 0, 0, 255))
+
+
+def test_chart_png():
+    blue, grey = (35, 137, 215, 255), (128, 128, 128, 255)
+    png = chart_png([(40, '1 (50.0%)'), (2, '10.%()')], 10, 4, blue, grey,
+                    scale=1)
+    image = PIL.Image.open(io.BytesIO(png), formats=['PNG'])
+    assert image.size == (40 + 4 + label_width('1 (50.0%)', 1), 2 * 10 + 4)
+    assert image.getpixel((0, 0)) == blue
+    assert image.getpixel((39, 9)) == blue
+    assert image.getpixel((40, 0)) == (0, 0, 0, 0)
+    assert image.getpixel((0, 12)) == (0, 0, 0, 0)  # gap
+    assert image.getpixel((1, 14)) == blue
+    assert image.getpixel((2, 14)) == (0, 0, 0, 0)
+    # top of the '1' of the first label, which is centered vertically
+    assert image.getpixel((44 + 1, 2)) == grey
+    assert image.getpixel((44, 2)) == (0, 0, 0, 0)
+
+
+def test_chart_png_without_bars():
+    with pytest.raises(ValueError):
+        chart_png([], 10, 4, (0, 0, 0, 255), (0, 0, 0, 255))
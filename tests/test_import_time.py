@@ -0,0 +1,15 @@
+# pylint: disable=missing-docstring
+import os
+
+from benchmarks.import_time import imported_modules
+
+TESTS = os.path.dirname(__file__)
+
+
+def test_app_imports_no_heavy_modules():
+    modules = imported_modules('app', path=[TESTS])
+    assert 'app' in modules
+    assert not any(name == 'PIL' or name.startswith('PIL.')
+                   for name in modules)
+    assert 'requests' not in modules
+    assert 'urllib3' not in modules
@@ -1,10 +1,15 @@
 # pylint: disable=missing-docstring
 import json
 import io
+import logging
+import time
 import jsonschema
 import PIL.Image
 import pytest
 import app
+import mattermost_api
+from poll import Poll
+from test_utils import force_settings
 import settings
 from tests import schemas
 
@@ -271,6 +276,77 @@ def test_end_admin(mocker, base_url, client):
     __validate_end_response(rd, 'Message', ['Yes', 'No'])
 
 
+def __end_poll_as(base_url, client, user_id):
+    data = {
+        'user_id': 'user0',
+        'text': 'Message'
+    }
+    response = client.post('/', data=data, base_url=base_url)
+    rd = json.loads(response.data.decode('utf-8'))
+    context = rd['attachments'][0]['actions'][-1]['integration']['context']
+
+    data = json.dumps({
+        'user_id': user_id,
+        'team_id': 'team0',
+        'context': context
+    })
+    response = client.post('/end', data=data,
+                           content_type='application/json',
+                           base_url=base_url)
+    assert response.status_code == 200
+    return json.loads(response.data.decode('utf-8'))
+
+
+@pytest.mark.parametrize('admin_delay, team_admin_delay', [
+    (0.3, 0.3),
+    (1.0, 0.0),
+])
+def test_end_concurrent_role_checks(mocker, base_url, client,
+                                    admin_delay, team_admin_delay):
+    def is_admin_user(user_id):
+        time.sleep(admin_delay)
+        return False
+
+    def is_team_admin(user_id, team_id):
+        time.sleep(team_admin_delay)
+        return user_id == 'user1' and team_id == 'team0'
+
+    mocker.patch('app.is_admin_user', new=is_admin_user)
+    mocker.patch('app.is_team_admin', new=is_team_admin)
+
+    begin = time.monotonic()
+    rd = __end_poll_as(base_url, client, 'user1')
+    assert time.monotonic() - begin < 0.55
+    __validate_end_response(rd, 'Message', ['Yes', 'No'])
+
+
+def test_end_role_checks_share_lookups(mocker, monkeypatch, base_url,
+                                       client):
+    monkeypatch.setattr(settings, 'MATTERMOST_PA_TOKEN', 'abc')
+    monkeypatch.setattr(mattermost_api.user_cache, 'ttl', 0)
+    requests_mock = mocker.patch.object(
+        mattermost_api.session(), 'get',
+        return_value=mocker.Mock(ok=True, text=json.dumps({
+            'locale': 'de', 'roles': 'system_user'})))
+
+    rd = __end_poll_as(base_url, client, 'user1')
+    assert 'ephemeral_text' in rd
+    urls = [c[0][0] for c in requests_mock.call_args_list]
+    # the user is also needed for the locale
+    assert urls.count('http://www.example.com/api/v4/users/user1') == 1
+    assert urls.count(
+        'http://www.example.com/api/v4/teams/team0/members/user1') == 1
+
+
+def test_end_not_allowed(mocker, base_url, client):
+    mocker.patch('app.is_admin_user', new=lambda user_id: False)
+    mocker.patch('app.is_team_admin', new=lambda user_id, team_id: False)
+
+    rd = __end_poll_as(base_url, client, 'user1')
+    assert 'update' not in rd
+    assert 'ephemeral_text' in rd
+
+
 def test_vote_invalid_poll(base_url, client):
     data = json.dumps({
         'user_id': 'user0',
@@ -433,9 +509,128 @@ def test_send_img_resizes_images(client):
     image = PIL.Image.open(buffer, formats=["PNG"])
     assert image.size == (110, 25)
 
+def test_send_img_cache_headers(client):
+    response = client.get('/img/bar_111.png')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert etag
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'max-age=31536000' in response.headers['Cache-Control']
+
+    # same width, same image
+    assert client.get('/img/bar_111.png').data == response.data
+    assert client.get('/img/bar_112.png').headers['ETag'] != etag
+
+    response = client.get('/img/bar_111.png',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert not response.data
+
+def test_send_img_debug_logging(client):
+    level = app.app.logger.level
+    app.app.logger.setLevel(logging.DEBUG)
+    try:
+        response = client.get('/img/bar_20.png')
+    finally:
+        app.app.logger.setLevel(level)
+    assert response.status_code == 200
+
 def test_send_img_rejects_invalid_path(client):
     response = client.get('/img/bar.png')
     assert response.status_code == 400
 
     response = client.get('/img/bar_10000000.png')
     assert response.status_code == 400
+
+    # the exported images have no leading zeros (see export-bars)
+    for filename in ('bar_0.png', 'bar_007.png', 'bar_20xpng'):
+        response = client.get('/img/' + filename)
+        assert response.status_code == 400
+
+def test_send_chart(client):
+    poll = Poll.create('user0', 'Message', vote_options=['Yes', 'No'],
+                       bars=True)
+    poll.vote('user0', 0)
+    version = poll.state().version
+    url = '/img/chart/{}/{}.png'.format(poll.id, version)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert 'immutable' in response.headers['Cache-Control']
+    image = PIL.Image.open(io.BytesIO(response.data), formats=["PNG"])
+    # only options with votes are shown while the poll is running
+    assert image.size[1] == 25
+    png = response.data
+
+    response = client.get(url, headers={
+        'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+    # the chart of a version never changes
+    poll.vote('user1', 1)
+    assert client.get(url).data == png
+    new_url = '/img/chart/{}/{}.png'.format(poll.id, version + 1)
+    response = client.get(new_url)
+    assert response.status_code == 200
+    image = PIL.Image.open(io.BytesIO(response.data), formats=["PNG"])
+    assert image.size[1] == 2 * 25 + app.CHART_GAP
+
+    # old versions which are not cached (e.g. in another worker) are
+    # redirected to the current version
+    app.chart_cache.clear()
+    response = client.get(url)
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith(new_url)
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert (poll.id, version) not in app.chart_cache._entries
+
+    assert client.get('/img/chart/{}/{}.png'.format(
+        poll.id, version + 2)).status_code == 404
+    assert client.get('/img/chart/123456789/1.png').status_code == 404
+    # poll ids are numbers, so this is not a chart at all
+    assert client.get('/img/chart/spam/1.png').status_code == 400
+
+def test_send_chart_secret(client):
+    poll = Poll.create('user0', 'Message', vote_options=['Yes', 'No'],
+                       secret=True, bars=True)
+    poll.vote('user0', 0)
+    url = '/img/chart/{}/{}.png'.format(poll.id, poll.state().version)
+    assert client.get(url).status_code == 404
+
+    poll.end()
+    url = '/img/chart/{}/{}.png'.format(poll.id, poll.state().version)
+    assert client.get(url).status_code == 200
+
+def test_send_chart_finished(client):
+    poll = Poll.create('user0', 'Message', vote_options=['Yes', 'No'],
+                       bars=True)
+    poll.vote('user0', 0)
+    poll.end()
+    url = '/img/chart/{}/{}.png'.format(poll.id, poll.state().version)
+    poll.end()  # e.g. a retried request
+
+    app.chart_cache.clear()  # e.g. another worker
+    assert client.get(url).status_code == 200
+    for version in range(poll.state().version):
+        response = client.get('/img/chart/{}/{}.png'.format(
+            poll.id, version))
+        assert response.status_code == 301
+        assert response.headers['Location'].endswith(url)
+    assert len(app.chart_cache) == 1
+
+@pytest.mark.parametrize('sendfile, path, header, value', [
+    ('x-accel-redirect', '/bars/', 'X-Accel-Redirect', '/bars/bar_20.png'),
+    ('x-sendfile', '/var/lib/bars/', 'X-Sendfile',
+     '/var/lib/bars/bar_20.png'),
+])
+def test_send_img_sendfile(client, sendfile, path, header, value):
+    with force_settings(BAR_SENDFILE=sendfile, BAR_SENDFILE_PATH=path):
+        response = client.get('/img/bar_20.png')
+        assert response.status_code == 200
+        assert response.mimetype == 'image/png'
+        assert response.headers[header] == value
+        assert 'immutable' in response.headers['Cache-Control']
+        assert not response.data
+
+        assert client.get('/img/bar.png').status_code == 400
@@ -10,7 +10,7 @@ def client():
     return app.app.test_client()
 
 
-def patched_user_locale(user_id):
+def patched_user_locale(user_id, fallback='en'):
     if user_id == 'de_user':
         return 'de'
     if user_id == 'en_user':
@@ -130,3 +130,30 @@ def test_create_de_vote_en(mocker, client):
 
     actual_ephemeral = response_json['ephemeral_text']
     assert "Ihre Wahl wurde aktualisiert" in actual_ephemeral
+
+
+def test_vote_api_unavailable(mocker, client):
+    """Test that the poll locale is used if the user locale is unknown."""
+    mocker.patch('app.user_locale', new=patched_user_locale)
+    response = client.post('/', data={
+        'user_id': 'de_user',
+        'text': 'Brezn?',
+    })
+    actions = json.loads(response.data.decode('utf-8'))[
+        'attachments'][0]['actions']
+    poll_id = actions[0]['integration']['context']['poll_id']
+
+    mocker.patch('app.user_locale',
+                 new=lambda user_id, fallback='en': fallback)
+    data = json.dumps({
+        'user_id': 'en_user',
+        'context': {
+            'poll_id': poll_id,
+            'vote': 0,
+        }
+    })
+    response = client.post('/vote', data=data, content_type='application/json')
+    assert response.status_code == 200
+
+    response_json = json.loads(response.data.decode('utf-8'))
+    assert "Ihre Wahl wurde aktualisiert" in response_json['ephemeral_text']
@@ -1,13 +1,19 @@
 # pylint: disable=missing-docstring
 from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
+import threading
+import time
+from flask import Flask
 import pytest
 
 import mattermost_api
 import settings
 
 
-Response = namedtuple('Response', ['ok', 'text'])
+# status_code is only checked if the response is not ok
+Response = namedtuple('Response', ['ok', 'text', 'status_code'],
+                      defaults=[404])
 
 
 @pytest.fixture
@@ -30,7 +36,7 @@ def set_pa_token(request):
     ('user5', 'en'),
 ])
 def test_user_locale(mocker, user_id, locale):
-    def requests_mock(url, headers):
+    def requests_mock(url, headers, timeout):
         assert url == 'http://www.example.com/api/v4/users/' + user_id
         assert headers['Authorization'] == 'Bearer 123abc456xyz'
         if user_id == 'user1':
@@ -45,7 +51,7 @@ def test_user_locale(mocker, user_id, locale):
             return Response(False, json.dumps({}))
         assert False
 
-    mocker.patch('requests.get', new=requests_mock)
+    mocker.patch.object(mattermost_api.session(), 'get', new=requests_mock)
 
     assert settings.MATTERMOST_PA_TOKEN
 
@@ -54,10 +60,10 @@ def test_user_locale(mocker, user_id, locale):
 
 
 def test_user_locale_no_token(mocker):
-    def requests_mock(url, headers):
+    def requests_mock(url, headers, timeout):
         assert False
 
-    mocker.patch('requests.get', new=requests_mock)
+    mocker.patch.object(mattermost_api.session(), 'get', new=requests_mock)
 
     assert not settings.MATTERMOST_PA_TOKEN
 
@@ -74,7 +80,7 @@ def test_user_locale_no_token(mocker):
     ('invalid', False),
 ])
 def test_user_is_admin(mocker, user_id, admin):
-    def requests_mock(url, headers):
+    def requests_mock(url, headers, timeout):
         assert url == 'http://www.example.com/api/v4/users/' + user_id
         assert headers['Authorization'] == 'Bearer 123abc456xyz'
         if user_id == 'user1':
@@ -89,7 +95,7 @@ def test_user_is_admin(mocker, user_id, admin):
             return Response(True, json.dumps({}))
         assert False
 
-    mocker.patch('requests.get', new=requests_mock)
+    mocker.patch.object(mattermost_api.session(), 'get', new=requests_mock)
 
     assert mattermost_api.is_admin_user(user_id) is admin
 
@@ -103,7 +109,7 @@ def test_user_is_admin(mocker, user_id, admin):
     ('invalid', False),
 ])
 def test_user_is_team_admin(mocker, user_id, team_admin):
-    def requests_mock(url, headers):
+    def requests_mock(url, headers, timeout):
         assert url == 'http://www.example.com/api/v4/teams/myteam/members/' + user_id
         assert headers['Authorization'] == 'Bearer 123abc456xyz'
         if user_id == 'user1':
@@ -118,6 +124,246 @@ def test_user_is_team_admin(mocker, user_id, team_admin):
             return Response(True, json.dumps({}))
         assert False
 
-    mocker.patch('requests.get', new=requests_mock)
+    mocker.patch.object(mattermost_api.session(), 'get', new=requests_mock)
 
     assert mattermost_api.is_team_admin(user_id, 'myteam') is team_admin
+
+
+@pytest.mark.usefixtures('set_pa_token')
+def test_resolve_usernames(mocker):
+    requested = []
+
+    def requests_mock(url, headers, **kwargs):
+        assert url == 'http://www.example.com/api/v4/users/ids'
+        assert headers['Authorization'] == 'Bearer 123abc456xyz'
+        requested.append(kwargs['json'])
+        users = [{'id': user_id, 'username': 'name_' + user_id}
+                 for user_id in kwargs['json'] if user_id != 'deleted']
+        return Response(True, json.dumps(users))
+
+    mocker.patch.object(mattermost_api.session(), 'post', new=requests_mock)
+    mocker.patch.object(settings, 'USERNAME_CHUNK_SIZE', 2, create=True)
+
+    assert mattermost_api.resolve_usernames([]) == {}
+    assert not requested
+
+    usernames = mattermost_api.resolve_usernames(
+        ['user3', 'user1', 'deleted', 'user1', 'user2'])
+    assert usernames == {'user1': 'name_user1', 'user2': 'name_user2',
+                         'user3': 'name_user3'}
+    assert sorted(requested) == [['deleted', 'user1'], ['user2', 'user3']]
+
+
+@pytest.mark.usefixtures('set_pa_token')
+def test_resolve_usernames_failure(mocker):
+    def requests_mock(url, headers, **kwargs):
+        if 'user3' in kwargs['json']:
+            return Response(False, '')
+        return Response(True, json.dumps([
+            {'id': user_id, 'username': user_id}
+            for user_id in kwargs['json']]))
+
+    mocker.patch.object(mattermost_api.session(), 'post', new=requests_mock)
+    mocker.patch.object(settings, 'USERNAME_CHUNK_SIZE', 2, create=True)
+
+    assert mattermost_api.resolve_usernames(['user1', 'user2']) is not None
+    assert mattermost_api.resolve_usernames(['user1', 'user2',
+                                             'user3']) is None
+
+
+@pytest.mark.usefixtures('set_pa_token')
+def test_user_cached(mocker):
+    requests_mock = mocker.patch.object(mattermost_api.session(), 'get', side_effect=[
+        Response(True, json.dumps({'locale': 'de', 'roles': 'system_user'})),
+        Response(False, ''),
+        Response(True, json.dumps({'roles': 'team_user team_admin'})),
+    ])
+
+    assert mattermost_api.user_locale('user1') == 'de'
+    assert mattermost_api.user_locale('user1') == 'de'
+    assert not mattermost_api.is_admin_user('user1')
+    assert requests_mock.call_count == 1
+
+    # unknown users are cached, too
+    assert not mattermost_api.is_admin_user('invalid')
+    assert not mattermost_api.is_admin_user('invalid')
+    assert requests_mock.call_count == 2
+
+    assert mattermost_api.is_team_admin('user1', 'team1')
+    assert mattermost_api.is_team_admin('user1', 'team1')
+    assert requests_mock.call_count == 3
+
+    stats = mattermost_api.user_cache.stats()
+    assert stats['hits'] == 4
+    assert stats['misses'] == 3
+
+
+@pytest.mark.usefixtures('set_pa_token')
+def test_resolve_usernames_cached(mocker):
+    requested = []
+
+    def requests_mock(url, headers, **kwargs):
+        requested.append(kwargs['json'])
+        return Response(True, json.dumps([
+            {'id': user_id, 'username': 'name_' + user_id}
+            for user_id in kwargs['json']]))
+
+    mocker.patch.object(mattermost_api.session(), 'post', new=requests_mock)
+
+    assert mattermost_api.resolve_usernames(['user1', 'user2']) == {
+        'user1': 'name_user1', 'user2': 'name_user2'}
+    assert mattermost_api.resolve_usernames(['user2', 'user3']) == {
+        'user2': 'name_user2', 'user3': 'name_user3'}
+    assert mattermost_api.resolve_usernames(['user3']) == {
+        'user3': 'name_user3'}
+    assert requested == [['user1', 'user2'], ['user3']]
+
+
+def test_session(mocker):
+    session = mattermost_api.session()
+    assert mattermost_api.session() is session
+    adapter = session.get_adapter('http://www.example.com')
+    assert adapter.max_retries.total == 2
+    # timeouts are not retried, MATTERMOST_TIMEOUT bounds each request
+    assert adapter.max_retries.connect == 0
+    assert adapter.max_retries.read == 0
+    assert 503 in adapter.max_retries.status_forcelist
+    assert not adapter.max_retries.respect_retry_after_header
+
+    # a forked process does not share the connections
+    mocker.patch('mattermost_api.os.getpid', return_value=-1)
+    assert mattermost_api.session() is not session
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        time.sleep(server.delay)
+        body = json.dumps({'locale': 'de', 'roles': 'system_admin',
+                           'id': 'user1', 'username': 'name1'}).encode()
+        self.send_response(server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server(monkeypatch, set_pa_token):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.requests = 0
+    server.delay = 0
+    server.status = 200
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,),
+                              daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(settings, 'MATTERMOST_URL',
+                        'http://127.0.0.1:{}'.format(server.server_port))
+    monkeypatch.setattr(settings, 'MATTERMOST_TIMEOUT', 0.1, raising=False)
+    monkeypatch.setattr(settings, 'MATTERMOST_RETRIES', 0, raising=False)
+    monkeypatch.setattr(settings, 'USER_CACHE_TTL', 0, raising=False)
+    monkeypatch.setattr(mattermost_api, '_session', None)
+    monkeypatch.setattr(mattermost_api.user_cache, 'ttl', 0)
+    monkeypatch.setattr(mattermost_api.breaker, 'threshold', 2)
+    yield server
+    mattermost_api.session().close()  # ends the kept-alive connections
+    server.shutdown()
+    server.server_close()
+
+
+def test_stub_server_available(stub_server):
+    assert mattermost_api.user_locale('user1', 'fr') == 'de'
+    assert mattermost_api.is_admin_user('user1')
+    assert stub_server.requests == 2
+
+
+def test_timeout_fallbacks(stub_server):
+    stub_server.delay = 0.5
+
+    begin = time.monotonic()
+    assert mattermost_api.user_locale('user1', 'fr') == 'fr'
+    assert not mattermost_api.is_admin_user('user1')
+    # the breaker is open now
+    assert mattermost_api.breaker.is_open()
+    assert not mattermost_api.is_team_admin('user1', 'team1')
+    assert mattermost_api.resolve_usernames(['user1']) is None
+    assert time.monotonic() - begin < 0.45
+    assert stub_server.requests == 2
+
+
+@pytest.mark.parametrize('status', [500, 503])
+def test_server_error_fallbacks(stub_server, status):
+    stub_server.status = status
+
+    assert mattermost_api.user_locale('user1', 'fr') == 'fr'
+    assert mattermost_api.resolve_usernames(['user1']) is None
+    assert mattermost_api.breaker.is_open()
+    assert not mattermost_api.is_admin_user('user1')
+    assert stub_server.requests == 2
+
+
+def test_unknown_user_is_no_failure(stub_server):
+    stub_server.status = 404
+
+    for _ in range(3):
+        assert mattermost_api.user_locale('user1', 'fr') == 'en'
+    assert not mattermost_api.breaker.is_open()
+    assert stub_server.requests == 3
+
+
+def test_breaker_half_open(stub_server, mocker):
+    now = [100.0]
+    mocker.patch('mattermost_api.time.monotonic', new=lambda: now[0])
+    stub_server.status = 503
+    mattermost_api.user_locale('user1')
+    mattermost_api.user_locale('user1')
+    assert mattermost_api.breaker.is_open()
+
+    # a single trial call after the reset timeout
+    now[0] += mattermost_api.breaker.reset_timeout
+    assert mattermost_api.user_locale('user1', 'fr') == 'fr'
+    assert mattermost_api.user_locale('user1', 'fr') == 'fr'
+    assert stub_server.requests == 3
+
+    stub_server.status = 200
+    now[0] += mattermost_api.breaker.reset_timeout
+    assert mattermost_api.user_locale('user1', 'fr') == 'de'
+    assert not mattermost_api.breaker.is_open()
+    assert mattermost_api.user_locale('user1', 'fr') == 'de'
+    assert stub_server.requests == 5
+
+
+@pytest.mark.usefixtures('set_pa_token')
+def test_lookups_memoized_per_request(mocker):
+    mocker.patch.object(mattermost_api.user_cache, 'ttl', 0)
+    requests_mock = mocker.patch.object(
+        mattermost_api.session(), 'get',
+        return_value=Response(True, json.dumps({
+            'locale': 'de', 'roles': 'system_user team_admin'})))
+    app = Flask(__name__)
+
+    with app.app_context():
+        assert mattermost_api.user_locale('user1') == 'de'
+        assert not mattermost_api.is_admin_user('user1')
+        assert mattermost_api.is_team_admin('user1', 'team1')
+        assert mattermost_api.is_team_admin('user1', 'team1')
+        assert requests_mock.call_count == 2
+        assert not mattermost_api.is_admin_user('user2')
+        assert requests_mock.call_count == 3
+
+    # a new request looks the user up again
+    with app.app_context():
+        assert mattermost_api.user_locale('user1') == 'de'
+        assert requests_mock.call_count == 4
@@ -1,8 +1,16 @@
 # pylint: disable=missing-docstring
+import threading
 import pytest
 import sqlite3
-import settings
-from poll import Poll, NoMoreVotesError, InvalidPollError
+import database
+from poll import Poll, NoMoreVotesError, InvalidPollError, metadata_cache
+
+
+@pytest.fixture(params=['rows', 'bitmask'])
+def ballot_storage(request, monkeypatch):
+    monkeypatch.setattr(database.settings, 'BALLOT_STORAGE', request.param,
+                        raising=False)
+    return request.param
 
 
 def test_init():
@@ -47,6 +55,10 @@ def test_update_database():
     assert 'bars' not in (c[1] for c in cur.fetchall())
     assert 'locale' not in (c[1] for c in cur.fetchall())
 
+    assert database.migrate(con) == database.SCHEMA_VERSION
+    assert database.schema_version(con) == database.SCHEMA_VERSION
+    assert database.migrate(con) == 0
+
     poll = Poll(con, 1)
     assert poll.creator_id == '9eu8hqt36tgg8q6w6ypu4ww1ch'
     assert poll.message == 'Spam with...'
@@ -57,7 +69,30 @@ def test_update_database():
     assert poll.max_votes == 2
     assert not poll.bars
 
+    # counts of existing votes are migrated
+    assert poll.snapshot().counts == (1, 1, 2)
+    assert poll.num_votes() == 4
+    assert poll.num_voters() == 3
+    assert database.check_vote_counts(con) == []
+    assert sorted(poll.voters(2)) == ['93tjw16rub858beagfirpwqdyh',
+                                      'adnq8psy6tr18n3gaiwg3ada9o']
+    assert poll.votes('adnq8psy6tr18n3gaiwg3ada9o') == [1, 2]
+
+
+def test_no_ddl_on_load():
+    poll = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'No'])
 
+    statements = []
+    poll.connection.set_trace_callback(statements.append)
+    Poll(poll.connection, poll.id)
+    poll.connection.set_trace_callback(None)
+
+    assert statements
+    for statement in statements:
+        assert statement.lstrip().upper().startswith('SELECT')
+
+
+@pytest.mark.usefixtures('ballot_storage')
 def test_vote():
     poll = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'Maybe', 'No'])
     assert poll.num_votes() == 0
@@ -101,6 +136,7 @@ def test_vote():
     assert poll.count_votes(3) == 0
 
 
+@pytest.mark.usefixtures('ballot_storage')
 def test_multiple_votes():
     poll = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'Maybe', 'No'],
                        max_votes=2)
@@ -145,6 +181,7 @@ def test_multiple_votes():
     assert poll.count_votes(3) == 0
 
 
+@pytest.mark.usefixtures('ballot_storage')
 @pytest.mark.parametrize('max_votes, expected_votes', [
     (1, ([1], [2], [])),
     (2, ([0, 1], [2], []))
@@ -164,6 +201,7 @@ def test_votes(max_votes, expected_votes):
     assert poll.votes('user2') == expected_votes[2]
 
 
+@pytest.mark.usefixtures('ballot_storage')
 @pytest.mark.parametrize('max_votes, expected', [
     (1, (1, 2, 1, 1)),
     (1, (1, 2, 1, 1)),
@@ -183,6 +221,55 @@ def test_num_voters(max_votes, expected):
     assert poll.num_voters() == expected[3]
 
 
+@pytest.mark.usefixtures('ballot_storage')
+def test_snapshot():
+    poll = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'Maybe', 'No'],
+                       max_votes=2)
+    snapshot = poll.snapshot()
+    assert not snapshot.finished
+    assert snapshot.counts == (0, 0, 0)
+    assert snapshot.num_votes == 0
+    assert snapshot.num_voters == 0
+
+    poll.vote('user0', 0)
+    poll.vote('user0', 2)
+    poll.vote('user1', 2)
+    snapshot = poll.snapshot()
+    assert snapshot.counts == (1, 0, 2)
+    assert snapshot.num_votes == 3
+    assert snapshot.num_voters == 2
+    assert snapshot.count_votes(2) == 2
+    assert snapshot.count_votes(3) == 0
+    assert snapshot.count_votes(-1) == 0
+
+    with pytest.raises(AttributeError):
+        snapshot.num_votes = 0
+
+    poll.end()
+    assert poll.snapshot().finished
+    assert snapshot.counts == poll.snapshot().counts
+
+
+@pytest.mark.usefixtures('ballot_storage')
+def test_vote_counts_consistent():
+    poll = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'Maybe', 'No'],
+                       max_votes=2)
+    single = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'No'])
+    for user, vote_id in [('user0', 0), ('user0', 1), ('user1', 1),
+                          ('user0', 1), ('user1', 2), ('user2', 0)]:
+        poll.vote(user, vote_id)
+        single.vote(user, vote_id % 2)
+    with pytest.raises(NoMoreVotesError):
+        poll.vote('user1', 0)
+
+    assert database.check_vote_counts(poll.connection) == []
+    assert poll.snapshot().counts == (2, 1, 1)
+    assert poll.num_voters() == 3
+    assert single.snapshot().counts == (2, 0)
+    assert single.num_voters() == 2
+
+
+@pytest.mark.usefixtures('ballot_storage')
 def test_end():
     poll = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'Maybe', 'No'],
                        max_votes=2)
@@ -203,6 +290,179 @@ def test_end():
     assert poll.count_votes(2) == 2
 
 
+@pytest.mark.usefixtures('ballot_storage')
+def test_concurrent_votes():
+    poll = Poll.create('user0123', 'Spam?', 'en',
+                       ['Yes', 'Maybe', 'No', 'Spam'], max_votes=2)
+
+    num_threads = 8
+    barrier = threading.Barrier(num_threads)
+
+    def vote(vote_id):
+        # each thread acts like a separate worker with its own connection
+        con = database.connect()
+        worker_poll = Poll(con, poll.id)
+        barrier.wait()
+        try:
+            worker_poll.vote('user0', vote_id)
+        except NoMoreVotesError:
+            pass
+        finally:
+            con.close()
+
+    threads = [threading.Thread(target=vote, args=(i % 4,))
+               for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(poll.votes('user0')) <= poll.max_votes
+
+
+@pytest.mark.usefixtures('ballot_storage')
+def test_group_commit_vote(monkeypatch):
+    monkeypatch.setattr(database.settings, 'DATABASE_GROUP_COMMIT_MS', 2,
+                        raising=False)
+    poll = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'Maybe', 'No'],
+                       max_votes=2)
+
+    threads = [threading.Thread(target=poll.vote, args=('user' + str(i), 1))
+               for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert poll.count_votes(1) == 10
+
+    poll.vote('user0', 0)
+    with pytest.raises(NoMoreVotesError):
+        poll.vote('user0', 2)
+    poll.vote('user0', 1)  # unvote
+    assert poll.votes('user0') == [0]
+
+    poll.end()
+    poll.vote('user1', 0)
+    assert poll.votes('user1') == [1]
+
+
+def test_vote_after_end_in_other_connection():
+    poll = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'No'])
+    con = database.connect()
+    other = Poll(con, poll.id)
+
+    other.end()
+    poll.vote('user0', 0)
+    assert poll.num_votes() == 0
+    con.close()
+
+
+def test_vote_is_single_transaction():
+    poll = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'No'])
+
+    statements = []
+    poll.connection.set_trace_callback(statements.append)
+    poll.vote('user0', 0)
+    poll.vote('user0', 1)
+    poll.connection.set_trace_callback(None)
+
+    assert [s for s in statements if s.startswith('BEGIN')] == \
+        ['BEGIN IMMEDIATE'] * 2
+    assert statements[-1] == 'COMMIT'
+    assert poll.votes('user0') == [1]
+    assert not poll.connection.in_transaction
+
+
+def test_ballot_many_options(monkeypatch):
+    monkeypatch.setattr(database.settings, 'BALLOT_STORAGE', 'bitmask',
+                        raising=False)
+    options = ['Option {}'.format(i) for i in range(130)]
+    poll = Poll.create('user0123', 'Spam?', 'en', options, max_votes=3)
+
+    poll.vote('user0', 2)
+    poll.vote('user0', 65)
+    poll.vote('user0', 129)
+    poll.vote('user1', 65)
+    assert poll.votes('user0') == [2, 65, 129]
+    assert poll.voters(65) == ['user0', 'user1']
+    assert poll.count_votes(65) == 2
+    assert poll.num_votes() == 4
+    assert poll.num_voters() == 2
+
+    with pytest.raises(NoMoreVotesError):
+        poll.vote('user0', 0)
+    poll.vote('user0', 2)  # unvote
+    poll.vote('user0', 129)  # unvote, word is removed
+    assert poll.votes('user0') == [65]
+    assert poll.num_votes() == 2
+    assert database.check_vote_counts(poll.connection) == []
+
+    cur = poll.connection.cursor()
+    cur.execute("""SELECT COUNT(*) FROM Ballots WHERE poll_id=?""",
+                (poll.id,))
+    assert cur.fetchone()[0] == 2  # one row per voter
+
+
+def test_version(ballot_storage):
+    poll = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'No'])
+    version = poll.state().version
+    assert poll.state().counts is None
+
+    poll.vote('user0', 0)
+    assert poll.state().version == version + 1
+    poll.vote('user0', 1)
+    assert poll.state().version == version + 2
+    assert poll.snapshot().version == version + 2
+
+    poll.end()
+    assert poll.state().version == version + 3
+    poll.vote('user1', 0)
+    assert poll.state().version == version + 3
+    poll.end()
+    assert poll.state().version == version + 3
+
+
+def test_version_no_more_votes(ballot_storage):
+    poll = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'Maybe', 'No'],
+                       max_votes=2)
+    poll.vote('user0', 0)
+    poll.vote('user0', 1)
+    version = poll.state().version
+    with pytest.raises(NoMoreVotesError):
+        poll.vote('user0', 2)
+    assert poll.state().version == version
+
+
+def test_convert_ballots(monkeypatch):
+    con = sqlite3.connect(':memory:')
+    database.migrate(con)
+    monkeypatch.setattr(database, 'connection', lambda: con)
+
+    poll = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'Maybe', 'No'],
+                       max_votes=2)
+    poll.vote('user0', 0)
+    poll.vote('user0', 2)
+    poll.vote('user1', 2)
+    snapshot = poll.snapshot()
+
+    assert database.convert_ballots(con) == 1
+    assert database.convert_ballots(con) == 0
+    assert con.execute("""SELECT COUNT(*) FROM Votes""").fetchone()[0] == 0
+    assert con.execute("""SELECT COUNT(*) FROM Ballots""").fetchone()[0] == 2
+
+    assert poll.snapshot() == snapshot
+    assert poll.votes('user0') == [0, 2]
+    assert poll.voters(2) == ['user0', 'user1']
+    assert database.check_vote_counts(con) == []
+
+    # voting continues in the new storage
+    poll.vote('user1', 1)
+    assert poll.votes('user1') == [1, 2]
+    assert con.execute("""SELECT COUNT(*) FROM Votes""").fetchone()[0] == 0
+    assert database.check_vote_counts(con) == []
+    metadata_cache.clear()  # the poll is not in the test database
+
+
 def test_load():
     poll = Poll.create('user0123', 'Spam?', 'en', ['Yes', 'Maybe', 'No'],
                        secret=True, public=True, max_votes=2, bars=True)
@@ -218,6 +478,28 @@ def test_load():
     assert poll.bars == poll2.bars
 
 
+def test_load_cached_metadata():
+    poll = Poll.create('user0123', 'Spam?', 'de', ['Yes', 'Maybe', 'No'],
+                       secret=True, public=True, max_votes=2, bars=True)
+    hits = metadata_cache.hits
+
+    statements = []
+    poll.connection.set_trace_callback(statements.append)
+    poll2 = Poll.load(poll.id)
+    poll.connection.set_trace_callback(None)
+
+    assert metadata_cache.hits == hits + 1
+    assert not statements
+    assert poll2.metadata() == poll.metadata()
+    assert poll2.vote_options == ['Yes', 'Maybe', 'No']
+
+    # mutable state is still read from the database
+    poll.vote('user0', 1)
+    poll.end()
+    assert poll2.votes('user0') == [1]
+    assert poll2.is_finished()
+
+
 def test_load_invalid():
     with pytest.raises(InvalidPollError):
         Poll.load('bla')
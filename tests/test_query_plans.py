@@ -0,0 +1,102 @@
+# pylint: disable=missing-docstring
+"""Checks that no statement executed by the Poll class needs a full table
+scan. All statements are recorded while exercising the public API and
+then analyzed with EXPLAIN QUERY PLAN.
+"""
+import sqlite3
+import pytest
+import database
+import formatters
+import poll as poll_module
+from poll import Poll, NoMoreVotesError
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    con = sqlite3.connect(':memory:')
+    database.migrate(con)
+    monkeypatch.setattr(database, 'connection', lambda: con)
+    # cached polls might come from a different database
+    poll_module.metadata_cache.clear()
+    formatters.render_cache.clear()
+    yield con
+    poll_module.metadata_cache.clear()
+    formatters.render_cache.clear()
+
+
+@pytest.fixture
+def statements(connection):
+    recorded = []
+    connection.set_trace_callback(recorded.append)
+    yield recorded
+    connection.set_trace_callback(None)
+
+
+def exercise_poll():
+    poll = Poll.create('user0', 'Spam', 'en', ['Yes', 'Maybe', 'No'],
+                       public=True, max_votes=2)
+    poll = Poll(database.connection(), poll.id)
+    poll = Poll.load(poll.id)
+    poll.vote('user0', 0)
+    poll.vote('user0', 1)
+    poll.vote('user1', 1)
+    poll.vote('user0', 1)  # unvote
+    poll.vote('user1', 2)
+    with pytest.raises(NoMoreVotesError):
+        poll.vote('user1', 0)
+
+    single = Poll.create('user0', 'Spam', 'en', ['Yes', 'No'])
+    single.vote('user0', 0)
+    single.vote('user0', 1)  # replace vote
+
+    for p in (poll, single):
+        p.snapshot()
+        p.num_votes()
+        p.num_voters()
+        p.count_votes(1)
+        p.voters(1)
+        p.voters_by_option()
+        p.votes('user0')
+        p.is_finished()
+        p.end()
+
+
+def query_plan(con, statement):
+    try:
+        rows = con.execute('EXPLAIN QUERY PLAN ' + statement).fetchall()
+    except sqlite3.ProgrammingError:
+        # older Python versions do not expand the bound parameters
+        parameters = [1] * statement.count('?')
+        rows = con.execute('EXPLAIN QUERY PLAN ' + statement,
+                           parameters).fetchall()
+    return [row[3] for row in rows]
+
+
+def is_full_scan(detail):
+    return detail.startswith('SCAN ') and detail != 'SCAN CONSTANT ROW'
+
+
+@pytest.mark.parametrize('ballot_storage', ['rows', 'bitmask'])
+def test_statements_use_indexes(monkeypatch, connection, statements,
+                                ballot_storage):
+    monkeypatch.setattr(database.settings, 'BALLOT_STORAGE', ballot_storage,
+                        raising=False)
+    exercise_poll()
+    connection.set_trace_callback(None)
+
+    queries = {
+        statement for statement in statements
+        if statement.lstrip().split()[0].upper() in
+        ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+    }
+    assert queries
+
+    for query in queries:
+        for detail in query_plan(connection, query):
+            assert not is_full_scan(detail), \
+                '{}\n-> {}'.format(' '.join(query.split()), detail)
+
+
+def test_full_scan_is_detected(connection):
+    plan = query_plan(connection, 'SELECT * FROM Votes WHERE voter=?')
+    assert any(is_full_scan(detail) for detail in plan)